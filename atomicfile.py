@@ -0,0 +1,36 @@
+import os
+import json
+import tempfile
+
+
+# replaces path content with data (str or bytes) so that readers see either the old or the new file,
+# each writer gets its own temporary file so concurrent writes to the same path never mix
+def atomic_write(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        if type(data) is bytes:
+            f = os.fdopen(fd, 'wb')
+        else:
+            f = os.fdopen(fd, 'w')
+        with f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    try:
+        d = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        os.fsync(d)
+        os.close(d)
+    except OSError:
+        pass
+
+
+def atomic_write_json(path, obj):
+    atomic_write(path, json.dumps(obj))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# compares size and load time of a user file holding raw isthereanydeal payloads
+# (legacy format) with the compact format, encoded as json and, if available, msgpack
+#
+# usage: bench_cache_format.py [games] [iterations]
+
+import os
+import sys
+import json
+import time
+import timeit
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import isthedeal_wrapper
+from userdata import UserData, UserConfigs, Game, UserDataManager, msgpack
+
+SHOPS = ["steam", "gog", "humblestore", "gamersgate", "fanatical", "indiegala", "wingamestore", "gamesplanet",
+         "2game", "dlgamer", "voidu", "gamebillet", "allyouplay", "macgamestore", "squenix"]
+
+
+# payloads shaped like the v01 game/prices and game/lowest responses
+def raw_payloads(i):
+    current = {'list': [], 'urls': {'game': "https://isthereanydeal.com/game/plain{}/info/".format(i)}}
+    for n, shop in enumerate(SHOPS):
+        current['list'].append({
+            'price_new': round(4.99 + n * 0.5, 2),
+            'price_old': 19.99,
+            'price_cut': 75 - n,
+            'url': "https://{}.example.com/store/app/{}/?affiliate=isthereanydeal".format(shop, i),
+            'shop': {'id': shop, 'name': shop.capitalize()},
+            'drm': ["steam"]
+        })
+    historical = {'shop': {'id': "gog", 'name': "GOG"}, 'price': 3.99, 'cut': 80, 'added': 1500000000,
+                  'urls': {'game': "https://isthereanydeal.com/game/plain{}/history/".format(i)}}
+    return current, historical
+
+
+def legacy_document(games):
+    cache = []
+    for i in range(games):
+        current, historical = raw_payloads(i)
+        cache.append({
+            'game_id': "app/{}".format(i), 'original_price': 19.99, 'price': 4.99, 'cut': 75,
+            'link': "http://store.steampowered.com/app/{}".format(i), 'name': "Game {}".format(i),
+            'deal': {'game_id': "app/{}".format(i), 'game_plain': "plain{}".format(i), 'current_j': current,
+                     'historical_j': historical, 'country': 'IT', 'fetched': time.time()}
+        })
+    return {'telegram_id': 1, 'username': "bench", 'configs': UserConfigs().to_dict(), 'exclude_list': [],
+            'cache': cache}
+
+
+def measure(label, path, iterations):
+    f = open(path, 'rb')
+    data = f.read()
+    f.close()
+    t = timeit.timeit(lambda: UserData.from_dict(UserDataManager.decode(data)), number=iterations) / iterations
+    print("{:<14} {:>10} bytes {:>10.2f} ms".format(label, len(data), t * 1000))
+
+
+if __name__ == '__main__':
+    games = 300
+    iterations = 20
+    if len(sys.argv) > 1:
+        games = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        iterations = int(sys.argv[2])
+
+    isthedeal_wrapper.regions['IT'] = {'region': 'eu1', 'currency': '€'}
+    legacy = legacy_document(games)
+    ud = UserData.from_dict(legacy)
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "1")
+        f = open(path, 'w')
+        json.dump(legacy, f)
+        f.close()
+        print("{} cached games, load time averaged on {} runs".format(games, iterations))
+        measure("legacy json", path, iterations)
+
+        UserDataManager(d, 'json').store_userdata(ud)
+        measure("compact json", path, iterations)
+
+        if msgpack is not None:
+            UserDataManager(d, 'msgpack').store_userdata(ud)
+            measure("compact msgpack", path, iterations)
+        else:
+            print("msgpack not installed, skipping binary encoding")
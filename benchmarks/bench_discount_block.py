@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# compares the discount_block parser used by steam_deallist with the previous
+# per game BeautifulSoup approach, using the samples in discount_blocks.json
+#
+# usage: bench_discount_block.py [iterations]
+
+import os
+import sys
+import json
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bs4 import BeautifulSoup
+import steam_deallist
+
+
+def sanitize_price_string(price):
+    return price.replace(",", ".").replace("-", "0")
+
+
+def parse_with_soup(block):
+    db = BeautifulSoup(block, "lxml")
+    original_price = float(sanitize_price_string(db.find("div", "discount_original_price").text[:-1]))
+    final_price = float(sanitize_price_string(db.find("div", "discount_final_price").text[:-1]))
+    cut = int(float(sanitize_price_string(db.find("div", "discount_pct").text[1:-1])))
+    return original_price, final_price, cut
+
+
+if __name__ == '__main__':
+    iterations = 200
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    f = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "discount_blocks.json"), 'r')
+    samples = json.load(f)
+    f.close()
+
+    # samples the old parser can not read (it breaks on thousands separators)
+    # are reported and left out of the comparison
+    comparable = []
+    for s in samples:
+        parsed = steam_deallist.parse_discount_block(s)
+        try:
+            expected = parse_with_soup(s)
+        except ValueError as e:
+            print("known baseline bug, BeautifulSoup parser failed ({}), parse_discount_block: {}".format(e, parsed))
+            continue
+        if expected != parsed:
+            print("mismatch on sample: {}".format(s))
+            exit(1)
+        comparable.append(s)
+
+    soup_time = timeit.timeit(lambda: [parse_with_soup(s) for s in comparable], number=iterations)
+    regex_time = timeit.timeit(lambda: [steam_deallist.parse_discount_block(s) for s in comparable], number=iterations)
+    all_time = timeit.timeit(lambda: [steam_deallist.parse_discount_block(s) for s in samples], number=iterations)
+
+    count = iterations * len(comparable)
+    print("{} of {} samples compared".format(len(comparable), len(samples)))
+    print("BeautifulSoup: {:.2f}us per block".format(soup_time * 1e6 / count))
+    print("parse_discount_block: {:.2f}us per block".format(regex_time * 1e6 / count))
+    print("speedup: {:.1f}x".format(soup_time / regex_time))
+    print("parse_discount_block on all samples: {:.2f}us per block".format(all_time * 1e6 / (iterations * len(samples))))
@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import logging
+from telegram import TelegramError
+from atomicfile import atomic_write_json
+
+
+# a rendered payload delivered to a list of recipients; the payload is stored once and
+# each delivered recipient is appended to a progress file, so an interrupted
+# broadcast can be resumed without sending the payload twice to anyone
+class Broadcast:
+    def __init__(self, state_path, name, messages, recipients, parse_mode=None):
+        self.state_path = state_path
+        self.progress_path = state_path + ".progress"
+        self.name = name
+        self.messages = messages
+        self.recipients = recipients
+        self.parse_mode = parse_mode
+
+    def store(self):
+        atomic_write_json(self.state_path, {
+            'name': self.name,
+            'messages': self.messages,
+            'recipients': self.recipients,
+            'parse_mode': self.parse_mode
+        })
+
+    @staticmethod
+    def load(state_path):
+        f = open(state_path, 'r')
+        try:
+            d = json.load(f)
+        finally:
+            f.close()
+        return Broadcast(state_path, d['name'], d['messages'], d['recipients'], d['parse_mode'])
+
+    def get_delivered(self):
+        delivered = set()
+        if os.path.isfile(self.progress_path):
+            f = open(self.progress_path, 'r')
+            for l in f:
+                l = l.strip()
+                # a partial last line means the process died while writing it
+                try:
+                    delivered.add(int(l))
+                except ValueError:
+                    pass
+            f.close()
+        return delivered
+
+    def run(self, send_queue):
+        delivered = self.get_delivered()
+        pending = [tid for tid in self.recipients if tid not in delivered]
+        if len(delivered) > 0:
+            logging.info("resuming broadcast {}, {} of {} recipients left".format(self.name, len(pending),
+                                                                                   len(self.recipients)))
+
+        start = time.time()
+        failed = 0
+        progress = open(self.progress_path, 'a')
+        try:
+            for tid in pending:
+                try:
+                    send_queue.send_messages(tid, self.messages, parse_mode=self.parse_mode)
+                except TelegramError as e:
+                    logging.error("error %s\nwhile broadcasting %s to %s", e, self.name, tid)
+                    failed += 1
+                progress.write("{}\n".format(tid))
+                progress.flush()
+        finally:
+            progress.close()
+
+        elapsed = time.time() - start
+        rate = 0
+        if elapsed > 0:
+            rate = len(pending) * len(self.messages) / elapsed
+        logging.info("broadcast {} done: {} recipients ({} failed) in {:.1f}s, {:.1f} messages/s".format(
+            self.name, len(pending), failed, elapsed, rate))
+
+        os.remove(self.state_path)
+        os.remove(self.progress_path)
+
+
+class BroadcastManager:
+    def __init__(self, path):
+        if type(path) is not str:
+            raise Exception("Missing broadcasts path")
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        self.path = path
+
+    def create(self, name, messages, recipients, parse_mode=None):
+        fname = "{}-{}".format(int(time.time() * 1000), name)
+        b = Broadcast(os.path.join(self.path, fname), name, messages, list(recipients), parse_mode)
+        b.store()
+        return b
+
+    # broadcasts left unfinished by a previous run, oldest first
+    def get_pending(self):
+        pending = []
+        for f in sorted(os.listdir(self.path)):
+            if f.endswith(".progress") or f.endswith(".tmp"):
+                continue
+            try:
+                pending.append(Broadcast.load(os.path.join(self.path, f)))
+            except Exception as e:
+                logging.error("invalid broadcast state {}: {}".format(f, e))
+        return pending
+
+    def resume_all(self, send_queue):
+        for b in self.get_pending():
+            b.run(send_queue)
@@ -0,0 +1,82 @@
+from bisect import bisect_left, bisect_right
+
+
+# sorted views over a game list, answering Game.is_applicable threshold queries with
+# range lookups; flags that depend only on the game data are computed once
+class GameIndex:
+    def __init__(self, games):
+        self.games = list(games)
+        n = len(self.games)
+        self.by_price = sorted(range(n), key=lambda i: self.games[i].price)
+        self.prices = [self.games[i].price for i in self.by_price]
+        self.by_original = sorted(range(n), key=lambda i: self.games[i].original_price)
+        self.originals = [self.games[i].original_price for i in self.by_original]
+        self.by_cut = sorted(range(n), key=lambda i: self.games[i].cut)
+        self.cuts = [self.games[i].cut for i in self.by_cut]
+
+        self.recommended = set()
+        self.historical_low = set()
+        self.cheaper_elsewhere = set()
+        for i, g in enumerate(self.games):
+            if g.is_recommended():
+                self.recommended.add(i)
+            if g.deal is not None:
+                historical = g.deal.historical
+                if historical is not None and historical.price is not None and g.price <= historical.price:
+                    self.historical_low.add(i)
+                current = g.deal.current
+                if current is not None and current.price is not None and current.shop['id'] != 'steam' \
+                        and current.price < g.price:
+                    self.cheaper_elsewhere.add(i)
+
+    def __len__(self):
+        return len(self.games)
+
+    # positions of games with price <= max_price and the positions of the others
+    def __split_price(self, max_price):
+        k = bisect_right(self.prices, max_price)
+        return self.by_price[:k], self.by_price[k:]
+
+    # positions in candidates that also belong to the range, scanning the shorter of the two
+    @staticmethod
+    def __intersect(candidates, in_candidates, range_positions, in_range):
+        if len(candidates) <= len(range_positions):
+            return [i for i in candidates if in_range(i)]
+        return [i for i in range_positions if in_candidates(i)]
+
+    def query(self, max_price, low_price_discount, min_discount, exclude, include_recommended=False,
+              at_historical_low=False, cheaper_elsewhere=False):
+        games = self.games
+        cheap, expensive = self.__split_price(max_price)
+
+        def is_cheap(i):
+            return games[i].price <= max_price
+
+        def is_expensive(i):
+            return games[i].price > max_price
+
+        matches = set()
+        # cheap games that were expensive before the discount
+        matches.update(GameIndex.__intersect(cheap, is_cheap,
+                                             self.by_original[bisect_right(self.originals, max_price):],
+                                             lambda i: games[i].original_price > max_price))
+        # low price games with a big enough discount
+        matches.update(GameIndex.__intersect(cheap, is_cheap,
+                                             self.by_cut[bisect_left(self.cuts, low_price_discount):],
+                                             lambda i: games[i].cut >= low_price_discount))
+        # expensive games with a big discount
+        matches.update(GameIndex.__intersect(expensive, is_expensive,
+                                             self.by_cut[bisect_left(self.cuts, min_discount):],
+                                             lambda i: games[i].cut >= min_discount))
+        if include_recommended:
+            matches.update(i for i in self.recommended if is_expensive(i))
+
+        if at_historical_low:
+            matches &= self.historical_low
+        if cheaper_elsewhere:
+            matches &= self.cheaper_elsewhere
+
+        if exclude is not None and len(exclude) > 0:
+            matches = [i for i in matches if games[i].gid not in exclude or games[i].price != exclude[games[i].gid]]
+
+        return [games[i] for i in sorted(matches)]
@@ -17,8 +17,11 @@ if test -d "$CACHE_DIR"; then
 		echo "Active users:"
 		count=0
 		for u in tids/*; do
+			case "$(basename "$u")" in
+				*[!0-9]*) continue;;
+			esac
 			if test -f "$u"; then
-				STR="$(jq -c "[(.username), (.telegram_id), (.cache | length)]" "$u" | sed -e 's/\[/Steam username: /' -e 's/,/, Telegram id: /' -e 's/,\([0-9]\+\)\]$/, cache size: \1/' 2> /dev/null)"
+				STR="$(jq -c "[(.username), (.telegram_id), ((.cache // .cache_ids) | length)]" "$u" | sed -e 's/\[/Steam username: /' -e 's/,/, Telegram id: /' -e 's/,\([0-9]\+\)\]$/, cache size: \1/' 2> /dev/null)"
 				if test -n "$STR"; then
 					echo -e "\t$STR"
 					count=$((count+1))
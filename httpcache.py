@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import urllib3
+from atomicfile import atomic_write
+
+# maximum number of in-flight requests towards the same host
+max_host_connections = 4
+
+urllib3.disable_warnings()
+# block=True makes the pool wait for a free connection instead of opening
+# new ones, so each host never sees more than max_host_connections requests
+http = urllib3.PoolManager(maxsize=max_host_connections, block=True)
+
+# optional HttpCache used by fetch and fetch_json
+cache = None
+
+
+# on disk store of response bodies revalidated with ETag/Last-Modified,
+# least recently used entries are evicted once max_size bytes are exceeded;
+# the index is only written by store, once a batch of requests is done
+class HttpCache:
+    def __init__(self, cache_path, max_size):
+        if type(cache_path) is not str:
+            raise Exception("Missing cache path")
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+        self.cache_path = cache_path
+        self.index_path = os.path.join(cache_path, "index")
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # {url: {'file', 'etag', 'last_modified', 'size', 'access'}}
+        self.index = {}
+        # {url: (file, parsed json)} for responses already decoded in this process
+        self.parsed = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if os.path.isfile(self.index_path):
+            f = open(self.index_path, 'r')
+            try:
+                self.index = json.load(f)
+            except:
+                logging.warning("invalid http cache index, starting empty")
+                self.index = {}
+            f.close()
+        # drop entries whose body went missing
+        self.index = {u: e for u, e in self.index.items() if os.path.isfile(os.path.join(self.cache_path, e['file']))}
+        # and bodies written after the last store, never evicted otherwise
+        files = {e['file'] for e in self.index.values()}
+        for f in os.scandir(self.cache_path):
+            if f.is_file() and f.path != self.index_path and f.name not in files:
+                try:
+                    os.remove(f.path)
+                except OSError:
+                    pass
+
+    def store(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self.index)
+            self.dirty = False
+        atomic_write(self.index_path, data)
+
+    def size(self):
+        with self.lock:
+            return sum(e['size'] for e in self.index.values())
+
+    def conditional_headers(self, url):
+        headers = {}
+        with self.lock:
+            entry = self.index.get(url)
+            if entry is not None:
+                if entry['etag'] is not None:
+                    headers['If-None-Match'] = entry['etag']
+                if entry['last_modified'] is not None:
+                    headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def read(self, url):
+        with self.lock:
+            entry = self.index.get(url)
+            if entry is None:
+                return None
+            entry['access'] = time.time()
+            self.dirty = True
+            fpath = os.path.join(self.cache_path, entry['file'])
+        try:
+            f = open(fpath, 'rb')
+            body = f.read()
+            f.close()
+        except OSError:
+            with self.lock:
+                self.index.pop(url, None)
+                self.dirty = True
+            return None
+        return body
+
+    def write(self, url, body, etag, last_modified):
+        if etag is None and last_modified is None:
+            return
+        if len(body) > self.max_size:
+            return
+
+        fname = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        # the indexed body stays valid until replaced, even if the write is interrupted
+        atomic_write(os.path.join(self.cache_path, fname), body)
+
+        with self.lock:
+            self.index[url] = {
+                'file': fname,
+                'etag': etag,
+                'last_modified': last_modified,
+                'size': len(body),
+                'access': time.time()
+            }
+            self.parsed.pop(url, None)
+            self.dirty = True
+            self.__evict()
+
+    def __evict(self):
+        total = sum(e['size'] for e in self.index.values())
+        if total <= self.max_size:
+            return
+        for url, entry in sorted(self.index.items(), key=lambda i: i[1]['access']):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_path, entry['file']))
+            except OSError:
+                pass
+            total -= entry['size']
+            del self.index[url]
+            self.parsed.pop(url, None)
+
+    def get_parsed(self, url):
+        with self.lock:
+            entry = self.index.get(url)
+            parsed = self.parsed.get(url)
+            if entry is not None and parsed is not None and parsed[0] == entry['file']:
+                entry['access'] = time.time()
+                return parsed[1]
+        return None
+
+    def set_parsed(self, url, obj):
+        with self.lock:
+            entry = self.index.get(url)
+            if entry is not None:
+                self.parsed[url] = (entry['file'], obj)
+
+
+# returns a (body, modified) tuple, body is None if the request failed and
+# modified is False when the server confirmed the cached copy is still valid
+def fetch(url):
+    headers = {}
+    if cache is not None:
+        headers = cache.conditional_headers(url)
+
+    request = http.request('GET', url, headers=headers)
+    if request.status == 304 and cache is not None:
+        body = cache.read(url)
+        if body is not None:
+            return body, False
+        # cached body went missing, ask again without validators
+        request = http.request('GET', url)
+
+    if request.status == 200:
+        if cache is not None:
+            cache.write(url, request.data, request.headers.get('ETag'), request.headers.get('Last-Modified'))
+        return request.data, True
+
+    logging.error("bad request: {}".format(request.status))
+    return None, False
+
+
+# like fetch, but decodes json bodies and skips decoding again when the server replies 304
+def fetch_json(url):
+    body, modified = fetch(url)
+    if body is None:
+        return None, False
+
+    if not modified and cache is not None:
+        parsed = cache.get_parsed(url)
+        if parsed is not None:
+            return parsed, False
+
+    j = json.loads(body.decode('utf-8'))
+    if cache is not None:
+        cache.set_parsed(url, j)
+    return j, modified
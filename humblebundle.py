@@ -3,11 +3,17 @@
 import isthedeal_wrapper
 import steam_deallist
 import json
+import logging
+import httpcache
 from bs4 import BeautifulSoup
-import urllib.request
 from userdata import Game
+from atomicfile import atomic_write_json
 import datetime
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+# bundle pages and steam searches resolved in parallel
+max_workers = 8
 
 
 class Bundle:
@@ -17,31 +23,27 @@ class Bundle:
         self.id = id
         self.gameGroups = {}
 
-    def scrapeGames(self, isthereanydealapikey = None):
-        soup = BeautifulSoup(urllib.request.urlopen(self.url), "lxml")
+    # returns the {group price: [game name]} listed on the bundle page, None if the
+    # page could not be read or did not change since its games were resolved
+    def scrapeNames(self):
+        body, modified = httpcache.fetch(self.url)
+        if body is None:
+            logging.error("could not read bundle page {}".format(self.url))
+            return None
+        if not modified and len(self.gameGroups) > 0:
+            # page did not change since games were resolved
+            return None
+        soup = BeautifulSoup(body, "lxml")
 
+        names = {}
         groups = soup.findAll("div", "main-content-row dd-game-row js-nav-row")
         for g in groups:
             price = g.findAll("h2", "dd-header-headline")[0].text.strip()
-            gnames = [d.text.strip() for d in g.findAll("div", "dd-image-box-caption dd-image-box-text dd-image-box-white ")]
-            games = []
-            for name in gnames:
-                gid, link = steam_deallist.query_steam_for_game(name)
-                if gid != None:
-                    newGame = Game(gid, 0, 0, 0, link, name, None)
-                    if isthereanydealapikey is not None:
-                        newGame.deal = isthedeal_wrapper.get_steam_price(isthereanydealapikey, gid)
-                        if newGame.deal is not None:
-                            newGame.cut = newGame.deal.current.cut
-                            newGame.price = newGame.deal.current.price
-                            if newGame.cut <= 0:
-                                newGame.original_price = newGame.price
-                            else:
-                                newGame.original_price = newGame.price * 100 / newGame.cut
-                    games.append(newGame)
-                else:
-                    games.append(Game("", 0, 0, 0, "", name, None))
-            self.gameGroups[price] = games
+            names[price] = [d.text.strip() for d in g.findAll("div", "dd-image-box-caption dd-image-box-text dd-image-box-white ")]
+        return names
+
+    def scrapeGames(self, isthereanydealapikey = None):
+        resolve_bundles([self], isthereanydealapikey)
 
     def __str__(self):
         ret = "{}\n{}\n".format(self.name, self.url)
@@ -73,16 +75,95 @@ class Bundle:
         return b
 
 
-def get_active_game_bundles(isthereanydealapikey = None):
+def __query_steam(name):
+    try:
+        return steam_deallist.query_steam_for_game(name)
+    except Exception as e:
+        logging.error("error while searching {} on steam: {}".format(name, e))
+        return None, None
+
+
+def __set_price(game, deal):
+    game.deal = deal
+    game.cut = deal.current.cut
+    game.price = deal.current.price
+    if game.cut <= 0:
+        game.original_price = game.price
+    else:
+        game.original_price = game.price * 100 / game.cut
+
+
+# scrapes the games of all bundles on a shared pool: pages are read in parallel, every
+# distinct title is searched on steam once and prices are fetched with batched requests
+def resolve_bundles(bundles, isthereanydealapikey = None, workers = None):
+    if workers is None:
+        workers = max_workers
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pages = list(executor.map(lambda b: b.scrapeNames(), bundles))
+
+        titles = set()
+        for names in pages:
+            if names is not None:
+                for gnames in names.values():
+                    titles.update(gnames)
+        titles = list(titles)
+        # {name: (gid, link)}
+        found = dict(zip(titles, executor.map(__query_steam, titles)))
+    if steam_deallist.search_cache is not None:
+        steam_deallist.search_cache.store()
+
+    resolved = []
+    for bundle, names in zip(bundles, pages):
+        if names is None:
+            continue
+        bundle.gameGroups = {}
+        for price, gnames in names.items():
+            games = []
+            for name in gnames:
+                gid, link = found[name]
+                if gid != None:
+                    newGame = Game(gid, 0, 0, 0, link, name, None)
+                    resolved.append(newGame)
+                    games.append(newGame)
+                else:
+                    games.append(Game("", 0, 0, 0, "", name, None))
+            bundle.gameGroups[price] = games
+
+    refresh_prices(resolved, isthereanydealapikey, workers)
+
+
+# updates the steam price of already resolved games, fetching each game once with batched requests
+def refresh_prices(games, isthereanydealapikey, workers = None):
+    gids = list(set(g.gid for g in games if g.gid is not None and len(g.gid) > 0))
+    if isthereanydealapikey is None or len(gids) <= 0:
+        return
+
+    deals = {}
+    for deal in isthedeal_wrapper.iter_multiple_games_lowest_prices(isthereanydealapikey, gids, 'steam',
+                                                                     workers=workers):
+        deal.select_shop('steam')
+        if deal.current is not None:
+            deals[deal.game_id] = deal
+
+    for g in games:
+        if g.gid in deals:
+            __set_price(g, deals[g.gid])
+
+
+# returns the active bundles without their games, None if the listing could not be read
+def get_active_bundle_list():
     json = isthedeal_wrapper.require_json("https://hr-humblebundle.appspot.com/androidapp/v2/service_check")
+    if json is None:
+        return None
+    return [Bundle(b['url'], b['bundle_name'], b['bundle_machine_name']) for b in json]
 
-    bundles = []
-    if json is not None:
-        for b in json:
-            bundle = Bundle(b['url'], b['bundle_name'], b['bundle_machine_name'])
-            bundle.scrapeGames(isthereanydealapikey)
-            bundles.append(bundle)
 
+def get_active_game_bundles(isthereanydealapikey = None):
+    bundles = get_active_bundle_list()
+    if bundles is None:
+        return []
+    resolve_bundles(bundles, isthereanydealapikey)
     return bundles
 
 
@@ -114,8 +195,38 @@ class BundleCache:
         if self.cache is None or self.is_outdated():
             self.update()
 
+    # only bundles that were not cached are scraped, the games of the others just get their prices refreshed
     def update(self):
-        self.cache = get_active_game_bundles(self.isthereanydealapikey)
+        active = get_active_bundle_list()
+        if active is None:
+            logging.warning("could not read active bundles, keeping cached ones")
+            if self.cache is None:
+                self.cache = []
+            return
+
+        cached = {}
+        if self.cache is not None:
+            cached = {b.id: b for b in self.cache}
+        bundles = []
+        new = []
+        for b in active:
+            old = cached.get(b.id)
+            # bundles whose page could not be read are scraped again
+            if old is None or len(old.gameGroups) <= 0:
+                new.append(b)
+                bundles.append(b)
+            else:
+                old.name = b.name
+                old.url = b.url
+                bundles.append(old)
+
+        resolve_bundles(new, self.isthereanydealapikey)
+        refresh_prices([g for b in bundles if b not in new for grp in b.gameGroups.values() for g in grp],
+                       self.isthereanydealapikey)
+        logging.info("bundles updated: {} new, {} refreshed, {} dropped".format(
+            len(new), len(bundles) - len(new), len(set(cached.keys()) - set(b.id for b in bundles))))
+
+        self.cache = bundles
         self.last_update = datetime.date.today()
         available = [b.id for b in self.cache]
         self.already_notified = list(set(self.already_notified) & set(available))
@@ -149,14 +260,7 @@ class BundleCache:
             ],
             'notified': self.already_notified
         }
-        if os.path.isfile(self.cache_path):
-            mode = "w"
-        else:
-            mode = "x"
-
-        f = open(self.cache_path, mode)
-        json.dump(dict, f)
-        f.close()
+        atomic_write_json(self.cache_path, dict)
 
 if __name__ == '__main__':
     for b in get_active_game_bundles(os.environ["ISTHEREANYDEAL_API_KEY"]):
@@ -1,11 +1,28 @@
-import urllib3
 import json
 import logging
+import os
+import time
+import threading
+import httpcache
+from atomicfile import atomic_write_json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# number of workers used by the concurrent multi-game lookups,
+# requests per host are capped by httpcache.max_host_connections
+max_workers = 8
+
+# {country: {'region': region, 'currency': sign}} index, see load_regions
+regions = {}
+# local copy of the regions table, used by refresh_regions
+regions_file = None
 
-urllib3.disable_warnings()
-http = urllib3.PoolManager()
+# used when a cached Deal is loaded before the regions table is available
+__fallback_regions = {
+    'IT': {'region': 'eu1', 'currency': '€'}
+}
 
-regions = {}
+# optional ttlcache.PersistentCache shared by every lookup, maps "shop:game_id" to plains
+plain_cache = None
 
 __multiple_api_limit = 25
 
@@ -51,102 +68,225 @@ class PriceDeal:
 
 
 class Deal:
-    def __init__(self, game_id, game_plain, current, historical, country, shop=None):
+    # version of the compact format written by to_dict, dictionaries without
+    # a version hold the raw isthereanydeal payloads and are upgraded on load
+    VERSION = 2
+
+    def __init__(self, game_id, game_plain, current, historical, country, shop=None, fetched=None, region=None):
         self.game_id = game_id
         self.game_plain = game_plain
-        self.current_j = current
-        self.historical_j = historical
+        # unix time of the price lookup
+        if fetched is None:
+            fetched = time.time()
+        self.fetched = fetched
         self.country = country
-        region = get_region_by_country(country)
+        if region is None:
+            # deserializing cached deals must never hit the network
+            region = get_region_by_country(country, False)
+        self.region = region
+
+        # best current offer for each shop, in the order returned by isthereanydeal (cheapest first)
+        self.shops = []
+        by_shop = {}
+        for d in current.get('list', []):
+            pd = PriceDeal.from_deal(d, region)
+            best = by_shop.get(pd.shop['id'])
+            if best is None:
+                by_shop[pd.shop['id']] = pd
+                self.shops.append(pd)
+            elif pd.price is not None and (best.price is None or pd.price < best.price):
+                best.price = pd.price
+                best.cut = pd.cut
+
         self.current = None
-        if 'list' in current.keys() and len(current['list']) > 0:
-            if shop is not None:
-                for d in current['list']:
-                    if d['shop']['id'] == shop:
-                        self.current = PriceDeal.from_deal(d, region)
-            if self.current is None:
-                self.current = PriceDeal.from_deal(current['list'][0], region)
+        if shop is not None:
+            self.current = by_shop.get(shop)
+        if self.current is None and len(self.shops) > 0:
+            self.current = self.shops[0]
         self.historical = PriceDeal.from_deal(historical, region)
 
+    # makes the offer of the given shop the current one, if that shop has one
+    def select_shop(self, shop):
+        for pd in self.shops:
+            if pd.shop['id'] == shop:
+                self.current = pd
+                return True
+        return False
+
     def __str__(self):
         return "{}: {}\nCurrent: {}\nHistorical: {}".format(self.game_id,
                                                             self.game_plain,
                                                             self.current,
                                                             self.historical)
 
+    @staticmethod
+    def __compact_price(pd):
+        if pd is None:
+            return None
+        return [pd.shop['id'], pd.shop['name'], pd.price, pd.cut]
+
+    @staticmethod
+    def __expand_price(cp, price_key, cut_key):
+        return {'shop': {'id': cp[0], 'name': cp[1]}, price_key: cp[2], cut_key: cp[3]}
+
     def to_dict(self):
+        current_shop = None
+        if self.current is not None:
+            current_shop = self.current.shop['id']
         return {
+            'v': Deal.VERSION,
             'game_id': self.game_id,
             'game_plain': self.game_plain,
-            'current_j': self.current_j,
-            'historical_j': self.historical_j,
-            'country': self.country
+            'country': self.country,
+            'region': self.region,
+            'fetched': self.fetched,
+            'shops': [Deal.__compact_price(pd) for pd in self.shops],
+            'current': current_shop,
+            'historical': Deal.__compact_price(self.historical)
         }
 
     @staticmethod
     def from_dict(ddata):
         if ddata is None:
             return None
-        return Deal(ddata['game_id'], ddata['game_plain'], ddata['current_j'], ddata['historical_j'], ddata['country'])
+        if ddata.get('v') == Deal.VERSION:
+            return Deal(ddata['game_id'], ddata['game_plain'],
+                        {'list': [Deal.__expand_price(cp, 'price_new', 'price_cut') for cp in ddata['shops']]},
+                        Deal.__expand_price(ddata['historical'], 'price', 'cut'),
+                        ddata['country'], ddata['current'], ddata['fetched'], ddata['region'])
+        # deals stored before timestamps were introduced are always stale
+        return Deal(ddata['game_id'], ddata['game_plain'], ddata['current_j'], ddata['historical_j'], ddata['country'],
+                    fetched=ddata.get('fetched', 0))
+
+    def age(self):
+        return time.time() - self.fetched
 
 
 def require_json(url):
-    request = http.request('GET', url)
-    if request.status == 200:
-        return json.loads(request.data.decode('utf-8'))
-    else:
-        logging.error("bad request: {}".format(request.status))
-        return None
+    return httpcache.fetch_json(url)[0]
+
+
+def __index_regions(data):
+    index = {}
+    for r in data.keys():
+        for c in data[r]['countries']:
+            index[c] = {'region': r, 'currency': data[r]['currency']['sign']}
+    return index
+
+
+# loads the regions table stored by refresh_regions, returns False if it is not available
+def load_regions(path=None):
+    global regions, regions_file
+    if path is not None:
+        regions_file = path
+    if regions_file is None or not os.path.isfile(regions_file):
+        return False
+
+    f = open(regions_file, 'r')
+    try:
+        regions = __index_regions(json.load(f))
+        ret = True
+    except:
+        logging.error("invalid regions file {}".format(regions_file))
+        ret = False
+    f.close()
+    return ret
+
+
+# downloads the regions table and stores it in regions_file, if set
+def refresh_regions():
+    global regions
+    j = require_json('https://api.isthereanydeal.com/v01/web/regions/')
+    if j is None:
+        return False
+
+    regions = __index_regions(j['data'])
 
+    if regions_file is not None:
+        atomic_write_json(regions_file, j['data'])
+    return True
 
-def get_region_by_country(country):
+
+def get_region_by_country(country, fetch=True):
     if country in regions:
         return regions[country]
 
-    j = require_json('https://api.isthereanydeal.com/v01/web/regions/')
-    region = None
-    if j is not None:
-        for r in j['data'].keys():
-            if country in j['data'][r]['countries']:
-                region = {'region': r, 'currency': j['data'][r]['currency']['sign']}
-                break
-
-    if region is not None:
-        regions[country] = region
-    else:
+    if fetch and refresh_regions() and country in regions:
+        return regions[country]
+
+    region = __fallback_regions.get(country)
+    if region is None:
         logging.error("invalid country {}".format(country))
     return region
 
 
+def __plain_key(shop, game_id):
+    return "{}:{}".format(shop, game_id)
+
+
 def get_game_plain_by_id(apy_key, game_id, shop='steam'):
+    if plain_cache is not None:
+        found, plain = plain_cache.get(__plain_key(shop, game_id))
+        if found:
+            return plain
+
     url = 'https://api.isthereanydeal.com/v02/game/plain/?key={}&shop={}&game_id={}'.format(apy_key, shop, game_id)
 
     j = require_json(url)
+    plain = None
     if j is not None and 'plain' in j['data']:
-        return j['data']['plain']
+        plain = j['data']['plain']
     else:
         logging.error("plain not found for game {}".format(game_id))
-    return None
+
+    # failed requests are not cached, only ids that the api could not resolve
+    if plain_cache is not None and j is not None:
+        plain_cache.put(__plain_key(shop, game_id), plain)
+        plain_cache.store()
+    return plain
+
+
+# splits id_list in a ({game_id: game_plain} cached, [game_id] missing) tuple,
+# ids known to be unresolvable are left out of both
+def get_cached_plains(id_list, shop='steam'):
+    if plain_cache is None:
+        return {}, list(id_list)
+
+    hits, missing = plain_cache.lookup([__plain_key(shop, gid) for gid in id_list])
+    prefix = len(__plain_key(shop, ""))
+    return {k[prefix:]: v for k, v in hits.items()}, [k[prefix:] for k in missing]
+
+
+def __cache_plains(requested, data, shop):
+    if plain_cache is None:
+        return
+    for gid in requested:
+        plain_cache.put(__plain_key(shop, gid), data.get(gid))
 
 
 # returns a {game_id: game_plain} dictionary
 def get_multiple_plain_by_ids(api_key, id_list, shop='steam'):
     if type(id_list) is str:
         id_list = id_list.split(',')
-	
-    out = {}
+
+    out, id_list = get_cached_plains(id_list, shop)
     while len(id_list) > 0:
-        s_list = ",".join(id_list[:__multiple_api_limit])
+        requested = id_list[:__multiple_api_limit]
+        s_list = ",".join(requested)
         id_list = id_list[__multiple_api_limit:]
     
         url = 'https://api.isthereanydeal.com/v01/game/plain/id/?key={}&shop={}&ids={}'.format(api_key, shop, s_list)
 
         j = require_json(url)
         if j is not None:
-            out.update(j['data'])
+            __cache_plains(requested, j['data'], shop)
+            out.update({k: v for k, v in j['data'].items() if v is not None})
         else:
             logging.warning("no plain found for ids: {}".format(s_list))
 
+    if plain_cache is not None:
+        plain_cache.store()
+
     if len(out) > 0:
         return out
     return None
@@ -185,39 +325,156 @@ def get_steam_price(api_key, game_id, country='IT'):
 
     return Deal(game_id, plain, cur_j[plain], hist_j[plain], country, 'steam')
 
-# returns a Deal list
-def get_multiple_games_lowest_prices(api_key, id_list, shop='steam', country='IT'):
-    plains_map = get_multiple_plain_by_ids(api_key, id_list, shop)
-    if plains_map is None:
+def __chunks(lst, size):
+    return [lst[i:i + size] for i in range(0, len(lst), size)]
+
+
+def __require_data(url):
+    j = require_json(url)
+    if j is None:
         return None
+    return j['data']
+
 
-    plains_list = [p for p in plains_map.values()]
+# returns a Deal list
+def get_multiple_games_lowest_prices(api_key, id_list, shop='steam', country='IT', workers=None):
+    return list(iter_multiple_games_lowest_prices(api_key, id_list, shop, country, workers))
 
-    dl = []
-    while len(plains_list) > 0:
-        p_list = ",".join(plains_list[:__multiple_api_limit])
-        plains_list = plains_list[__multiple_api_limit:]
 
-        cur_j, hist_j = __get_lowest(api_key, p_list, country)
+# yields Deals as soon as both current and historical prices of their batch are available.
+# Plain batches are resolved in parallel and, as soon as one completes, its prices and
+# historical lows batches are queued on the same pool; workers=1 runs requests one at a time
+def iter_multiple_games_lowest_prices(api_key, id_list, shop='steam', country='IT', workers=None):
+    if type(id_list) is str:
+        id_list = id_list.split(',')
+    if workers is None:
+        workers = max_workers
 
-        for gid in id_list:
-            if gid in plains_map:
-                pl = plains_map[gid]
+    region = get_region_by_country(country)['region']
+
+    plains_map, missing = get_cached_plains(id_list, shop)
+    # reverse {plain: [game_id]} index used to join price batches back to ids
+    gids_by_plain = {}
+    for gid, pl in plains_map.items():
+        gids_by_plain.setdefault(pl, []).append(gid)
+    # {plains batch: [current data, historical data]}, a batch is complete when both are set
+    batches = {}
+    found = set()
+
+    def submit_prices(plains):
+        plains = tuple(plains)
+        p_list = ",".join(plains)
+        current_url = 'https://api.isthereanydeal.com/v01/game/prices/{}/?key={}&plains={}&country={}'.format(
+            region, api_key, p_list, country)
+        historical_url = 'https://api.isthereanydeal.com/v01/game/lowest/{}/?key={}&plains={}'.format(
+            region, api_key, p_list)
+        batches[plains] = [None, None]
+        pending[executor.submit(__require_data, current_url)] = ('prices', plains)
+        pending[executor.submit(__require_data, historical_url)] = ('lowest', plains)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        for ids in __chunks(missing, __multiple_api_limit):
+            url = 'https://api.isthereanydeal.com/v01/game/plain/id/?key={}&shop={}&ids={}'.format(
+                api_key, shop, ",".join(ids))
+            pending[executor.submit(__require_data, url)] = ('plain', ids)
+        for plains in __chunks(list(set(plains_map.values())), __multiple_api_limit):
+            submit_prices(plains)
+
+        while len(pending) > 0:
+            fut = next(as_completed(list(pending.keys())))
+            kind, batch = pending.pop(fut)
+            try:
+                data = fut.result()
+            except Exception as e:
+                logging.error("error while fetching {} batch: {}".format(kind, e))
+                data = None
+
+            if data is None:
+                logging.warning("no {} found for: {}".format(kind, ",".join(batch)))
+                if kind != 'plain':
+                    batches.pop(batch, None)
+                continue
+
+            if kind == 'plain':
+                __cache_plains(batch, data, shop)
+                plains = set()
+                for gid, pl in data.items():
+                    if pl is not None:
+                        plains_map[gid] = pl
+                        gids_by_plain.setdefault(pl, []).append(gid)
+                        plains.add(pl)
+                if len(plains) > 0:
+                    submit_prices(plains)
+                continue
+
+            prices = batches.get(batch)
+            if prices is None:
+                # the other half of the batch failed
+                continue
+            prices[0 if kind == 'prices' else 1] = data
+            if prices[0] is None or prices[1] is None:
+                continue
+
+            cur_j, hist_j = batches.pop(batch)
+            for pl in batch:
                 if pl in cur_j and pl in hist_j:
-                    dl.append(Deal(gid, pl, cur_j[pl], hist_j[pl], country))
-            else:
-                logging.warning("gid {} was not resolved".format(gid))
-
-    for i in id_list:
-        found = False
-        for d in dl:
-            if d.game_id == i:
-                found = True
-                break
-        if not found:
-            if i in plains_map:
-                logging.warning("{} ({}) not found".format(plains_map[i], i))
+                    for gid in gids_by_plain.get(pl, []):
+                        if gid not in found:
+                            found.add(gid)
+                            yield Deal(gid, pl, cur_j[pl], hist_j[pl], country)
+
+    if plain_cache is not None:
+        plain_cache.store()
+
+    for gid in id_list:
+        if gid not in found:
+            if gid in plains_map:
+                logging.warning("{} ({}) not found".format(plains_map[gid], gid))
             else:
-                logging.warning("{} not found".format(i))
+                logging.warning("{} not found".format(gid))
 
-    return dl
+
+# market information for a set of games fetched once and shared by every user
+# refreshed during the same update cycle, safe to use from multiple threads
+class PriceSnapshot:
+    def __init__(self, api_key, shop='steam', country='IT'):
+        self.api_key = api_key
+        self.shop = shop
+        self.country = country
+        self.deals = {}
+        self.lock = threading.Lock()
+        # {game_id: Event} set once the lookup that requested the id completed
+        self.requested = {}
+
+    # fetches prices for the ids that were never requested in this snapshot,
+    # ids already being fetched by another thread are waited for
+    def update(self, id_list):
+        done = threading.Event()
+        missing = []
+        waiting = []
+        with self.lock:
+            for gid in set(id_list):
+                ev = self.requested.get(gid)
+                if ev is None:
+                    self.requested[gid] = done
+                    missing.append(gid)
+                elif ev not in waiting:
+                    waiting.append(ev)
+
+        if len(missing) > 0:
+            try:
+                for d in iter_multiple_games_lowest_prices(self.api_key, missing, self.shop, self.country):
+                    with self.lock:
+                        self.deals[d.game_id] = d
+            finally:
+                done.set()
+            logging.info("price snapshot: {} games requested, {} deals available".format(len(self.requested),
+                                                                                         len(self.deals)))
+
+        for ev in waiting:
+            ev.wait()
+
+    def get(self, game_id):
+        with self.lock:
+            return self.deals.get(game_id)
@@ -0,0 +1,175 @@
+import os
+import json
+import logging
+import threading
+from userdata import UserData, UserDataManager
+from atomicfile import atomic_write_json
+
+
+# in memory fingerprint of a json value, used to find what changed since the last store
+def digest(obj):
+    return hash(json.dumps(obj, sort_keys=True))
+
+
+# applies a journal record to a userdata dictionary, games are kept in an {id: game} dictionary
+def apply_record(doc, games, record):
+    op = record['op']
+    if op == 'set':
+        doc[record['key']] = record['value']
+    elif op == 'game':
+        games[record['value']['game_id']] = record['value']
+    elif op == 'del_game':
+        games.pop(record['game_id'], None)
+    elif op == 'order':
+        ordered = {gid: games[gid] for gid in record['game_ids'] if gid in games}
+        games.clear()
+        games.update(ordered)
+    else:
+        raise Exception("unknown journal record {}".format(op))
+
+
+# stores each user as a json snapshot (same format as UserDataManager) plus an append only
+# journal of changes, the journal is merged in a new snapshot once it grows past compact_after records;
+# snapshot and records carry a generation, records older than the snapshot were already merged in it
+class JournaledUserDataManager(UserDataManager):
+    COMPACT_AFTER_DEFAULT = 100
+
+    def __init__(self, cache_path, compact_after=None, catalog=None):
+        UserDataManager.__init__(self, cache_path, catalog=catalog)
+        if compact_after is None:
+            compact_after = JournaledUserDataManager.COMPACT_AFTER_DEFAULT
+        self.compact_after = compact_after
+        self.lock = threading.Lock()
+        # {tid: (top level keys digests, {game id: digest}, game ids order, generation, journal records)}
+        self.state = {}
+
+    def __paths(self, tid):
+        snapshot = os.path.join(self.cache_path, str(tid))
+        return snapshot, snapshot + ".journal"
+
+    # returns the current userdata dictionary (None if unknown), the snapshot generation and the number
+    # of journal records, or None as records count if the journal contains incomplete or stale records
+    # and needs to be rewritten
+    def __read(self, tid):
+        snapshot, journal = self.__paths(tid)
+        doc = None
+        if os.path.isfile(snapshot):
+            f = open(snapshot, 'r')
+            try:
+                doc = json.load(f)
+            except Exception as e:
+                logging.error("corrupted snapshot for {}: {}".format(tid, e))
+            f.close()
+
+        if doc is None:
+            doc = {}
+        generation = doc.pop('generation', 0)
+        games = {g['game_id']: g for g in doc.get('cache', [])}
+
+        records = 0
+        torn = False
+        if os.path.isfile(journal):
+            f = open(journal, 'r')
+            for l in f:
+                try:
+                    record = json.loads(l)
+                except ValueError:
+                    # a write interrupted by a crash, records appended later are on the following lines
+                    logging.warning("skipping incomplete journal record for {}".format(tid))
+                    torn = True
+                    continue
+                if record.get('generation', 0) < generation:
+                    # left by a compaction interrupted after writing the snapshot
+                    torn = True
+                    continue
+                apply_record(doc, games, record)
+                records += 1
+            f.close()
+        if torn:
+            records = None
+
+        if 'telegram_id' not in doc:
+            return None, generation, records
+        if 'cache' in doc or len(games) > 0:
+            doc['cache'] = list(games.values())
+        return doc, generation, records
+
+    @staticmethod
+    def __digests(doc):
+        keys = {k: digest(v) for k, v in doc.items() if k != 'cache'}
+        games = {g['game_id']: digest(g) for g in doc.get('cache', [])}
+        order = [g['game_id'] for g in doc.get('cache', [])]
+        return keys, games, order
+
+    def get_userdata(self, tid):
+        if type(tid) is not int:
+            raise Exception("Telegram id needs to be a valid int, found type {}".format(type(tid)))
+
+        doc, generation, records = self.__read(tid)
+        if doc is None:
+            return None
+        try:
+            return UserData.from_dict(doc, self.catalog)
+        except Exception as e:
+            logging.error("invalid userdata for {}: {}".format(tid, e))
+        return None
+
+    def store_userdata(self, user_data):
+        if type(user_data) is not UserData:
+            raise Exception("user_data must be a UserData object")
+
+        tid = user_data.tid
+        doc = user_data.to_dict(self.catalog)
+        if self.catalog is not None:
+            self.catalog.store()
+        keys, games, order = JournaledUserDataManager.__digests(doc)
+
+        with self.lock:
+            state = self.state.get(tid)
+        if state is None:
+            old, generation, records = self.__read(tid)
+            if old is None or records is None:
+                self.__compact(tid, doc, generation)
+                return
+            state = JournaledUserDataManager.__digests(old) + (generation, records)
+        old_keys, old_games, old_order, generation, records = state
+
+        changes = []
+        for k, d in keys.items():
+            if old_keys.get(k) != d:
+                changes.append({'op': 'set', 'key': k, 'value': doc[k]})
+        for g in doc.get('cache', []):
+            if old_games.get(g['game_id']) != games[g['game_id']]:
+                changes.append({'op': 'game', 'value': g})
+        for gid in old_games.keys():
+            if gid not in games:
+                changes.append({'op': 'del_game', 'game_id': gid})
+        # replayed 'game' records append new games at the end
+        replayed = [gid for gid in old_order if gid in games] + [gid for gid in order if gid not in old_games]
+        if replayed != order:
+            changes.append({'op': 'order', 'game_ids': order})
+
+        if records + len(changes) > self.compact_after:
+            self.__compact(tid, doc, generation)
+            return
+
+        if len(changes) > 0:
+            snapshot, journal = self.__paths(tid)
+            f = open(journal, 'a')
+            f.write("".join(json.dumps(dict(c, generation=generation)) + "\n" for c in changes))
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+
+        with self.lock:
+            self.state[tid] = (keys, games, order, generation, records + len(changes))
+
+    # writes a fresh snapshot with the next generation and drops the journal, if a crash
+    # leaves the journal behind its records are older than the snapshot and skipped
+    def __compact(self, tid, doc, generation):
+        snapshot, journal = self.__paths(tid)
+        atomic_write_json(snapshot, dict(doc, generation=generation + 1))
+        if os.path.isfile(journal):
+            os.remove(journal)
+        with self.lock:
+            self.state[tid] = JournaledUserDataManager.__digests(doc) + (generation + 1, 0)
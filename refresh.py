@@ -0,0 +1,94 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+# a job running in background, its progress is forwarded to every caller waiting on it
+class Refresh:
+    def __init__(self, keys):
+        self.keys = keys
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.status = None
+        self.future = None
+
+    @staticmethod
+    def __call(callback, *args):
+        try:
+            callback(*args)
+        except Exception as e:
+            logging.error("error in refresh callback: {}".format(e))
+
+    # callback is invoked with every progress message, starting from the last one sent
+    def listen(self, callback):
+        with self.lock:
+            self.listeners.append(callback)
+            status = self.status
+        if status is not None:
+            Refresh.__call(callback, status)
+
+    def progress(self, status):
+        with self.lock:
+            self.status = status
+            listeners = list(self.listeners)
+        for l in listeners:
+            Refresh.__call(l, status)
+
+    # callback is invoked with a (result, error) pair once the job completes, right away if it already did
+    def when_done(self, callback):
+        def done(future):
+            try:
+                result = future.result()
+                error = None
+            except Exception as e:
+                result = None
+                error = e
+            Refresh.__call(callback, result, error)
+        self.future.add_done_callback(done)
+
+
+# runs refreshes on a thread pool, a request for keys that are already being refreshed
+# joins the running job instead of starting another one
+class RefreshManager:
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        # {key: Refresh}
+        self.running = {}
+
+    # returns a (Refresh, started) tuple, fn is called with the new Refresh only if started is True
+    def submit(self, keys, fn):
+        with self.lock:
+            for k in keys:
+                r = self.running.get(k)
+                if r is not None:
+                    return r, False
+            r = Refresh(keys)
+            for k in keys:
+                self.running[k] = r
+            r.future = self.executor.submit(fn, r)
+        r.future.add_done_callback(lambda f: self.__release(r))
+        return r, True
+
+    # queues a job for keys that starts once previous completed, requests for keys join it meanwhile
+    def submit_after(self, previous, keys, fn):
+        def run(refresh):
+            wait([previous.future])
+            return fn(refresh)
+
+        with self.lock:
+            r = Refresh(keys)
+            for k in keys:
+                self.running[k] = r
+            r.future = self.executor.submit(run, r)
+        r.future.add_done_callback(lambda f: self.__release(r))
+        return r
+
+    def __release(self, refresh):
+        with self.lock:
+            for k in refresh.keys:
+                if self.running.get(k) is refresh:
+                    del self.running[k]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,117 @@
+import time
+import logging
+import threading
+from telegram.error import RetryAfter, TimedOut, NetworkError, BadRequest
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+# greedily joins text blocks in as few messages as possible, each shorter than limit
+def pack_messages(blocks, separator="\n\n", limit=TELEGRAM_MESSAGE_LIMIT):
+    messages = []
+    current = None
+    for b in blocks:
+        if current is None:
+            current = b
+        elif len(current) + len(separator) + len(b) <= limit:
+            current += separator + b
+        else:
+            messages.append(current)
+            current = b
+    if current is not None:
+        messages.append(current)
+    return messages
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    # blocks until a token is available
+    def acquire(self):
+        while True:
+            with self.lock:
+                self.__refill(time.monotonic())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    # stops handing out tokens for the given number of seconds
+    def pause(self, seconds):
+        with self.lock:
+            self.__refill(time.monotonic())
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def is_full(self):
+        with self.lock:
+            self.__refill(time.monotonic())
+            return self.tokens >= self.capacity
+
+
+# paces outgoing messages under telegram flood limits, waiting when asked to retry
+class SendQueue:
+    GLOBAL_RATE = 30
+    CHAT_RATE = 1
+    CHAT_BURST = 3
+    MAX_RETRIES = 5
+
+    def __init__(self, bot, global_rate=None, chat_rate=None, chat_burst=None):
+        if global_rate is None:
+            global_rate = SendQueue.GLOBAL_RATE
+        if chat_rate is None:
+            chat_rate = SendQueue.CHAT_RATE
+        if chat_burst is None:
+            chat_burst = SendQueue.CHAT_BURST
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.lock = threading.Lock()
+
+    def __chat_bucket(self, chat_id):
+        with self.lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                # forget idle chats so that the map does not grow with the user base
+                if len(self.chat_buckets) > 1000:
+                    self.chat_buckets = {c: b for c, b in self.chat_buckets.items() if not b.is_full()}
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+                self.chat_buckets[chat_id] = bucket
+            return bucket
+
+    # sends a message as soon as limits allow it, raises TelegramError if it can not be delivered
+    def send_message(self, chat_id, text, **kwargs):
+        chat_bucket = self.__chat_bucket(chat_id)
+        retries = 0
+        while True:
+            chat_bucket.acquire()
+            self.global_bucket.acquire()
+            try:
+                return self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            except RetryAfter as e:
+                logging.warning("flood limit hit while sending to %s, retrying in %ss", chat_id, e.retry_after)
+                chat_bucket.pause(e.retry_after)
+                self.global_bucket.pause(e.retry_after)
+            except BadRequest:
+                # subclass of NetworkError, but permanent (unknown chat, invalid markup)
+                raise
+            except (TimedOut, NetworkError) as e:
+                if retries >= SendQueue.MAX_RETRIES:
+                    raise
+                retries += 1
+                time.sleep(2 ** retries)
+
+    def send_messages(self, chat_id, texts, **kwargs):
+        for t in texts:
+            self.send_message(chat_id, t, **kwargs)
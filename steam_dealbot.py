@@ -7,6 +7,15 @@ env_vars = {
     'notification_file': "NOTIFICATION_FILE"
 }
 
+optional_env_vars = {
+    'update_workers': "UPDATE_WORKERS",
+    'refresh_workers': "REFRESH_WORKERS",
+    'cache_freshness': "CACHE_FRESHNESS_HOURS",
+    'userdata_backend': "USERDATA_BACKEND",
+    'userdata_cache_size': "USERDATA_CACHE_SIZE",
+    'userdata_encoding': "USERDATA_ENCODING"
+}
+
 import sys
 import os
 import logging
@@ -27,6 +36,14 @@ if not os.path.isdir(cache_dir):
     exit(2)
 
 bundle_cache_file = os.path.join(cache_dir, "bundles_cache")
+plain_cache_file = os.path.join(cache_dir, "plains_cache")
+search_cache_file = os.path.join(cache_dir, "steam_search_cache")
+steam_apps_file = os.path.join(cache_dir, "steam_apps")
+regions_file = os.path.join(cache_dir, "regions")
+http_cache_dir = os.path.join(cache_dir, "http")
+broadcasts_dir = os.path.join(cache_dir, "broadcasts")
+userdata_db_file = os.path.join(cache_dir, "users.db")
+catalog_file = os.path.join(cache_dir, "games_catalog")
 tid_cache_dir = os.path.join(cache_dir, "tids")
 if not os.path.isdir(tid_cache_dir):
     os.mkdir(tid_cache_dir)
@@ -34,34 +51,225 @@ if not os.path.isdir(tid_cache_dir):
 from telegram.ext import Updater, CommandHandler, ConversationHandler, MessageHandler, Filters
 from telegram import ReplyKeyboardRemove, ReplyKeyboardMarkup, TelegramError, ParseMode
 import steam_deallist
+import isthedeal_wrapper
+import httpcache
 import datetime
-from userdata import UserDataManager
+import time
+import atexit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from userdata import UserDataManager, CachedUserDataManager, GameCatalog, Exclude
+from userdata_sqlite import SqliteUserDataManager
+from journal import JournaledUserDataManager
 from humblebundle import BundleCache
+from ttlcache import PersistentCache
+from sendqueue import SendQueue, pack_messages
+from broadcast import BroadcastManager
+from subscribers import SubscriberIndex
+from steamapps import SteamAppIndex
+from refresh import RefreshManager
 
 # #### MISC ####
 
 def send_deals(bot, tid, games):
+    global send_queue
     try:
         if games is None or len(games) <= 0:
-            bot.send_message(chat_id=tid, text="No deals available right now")
+            send_queue.send_message(tid, "No deals available right now")
         else:
-            for g in games:
-                bot.send_message(chat_id=tid, parse_mode=ParseMode.HTML, text=g.to_string(True))
+            send_queue.send_messages(tid, pack_messages([g.to_string(True) for g in games]),
+                                     parse_mode=ParseMode.HTML)
     except TelegramError as e:
         logging.error("error %s\nwhile sending games to %s", e, tid)
 
 
+# renders bundles as a list of html messages, the same for every user
+def render_bundles(bundles):
+    messages = []
+    for bundle in bundles:
+        messages.append('<b>VVV</b> <a href="{}">{}</a> <b>VVV</b>'.format(bundle.url, bundle.name))
+        for grp in bundle.gameGroups.keys():
+            messages.append('<i>{}</i>'.format(grp))
+            games = bundle.gameGroups[grp]
+            if games is None or len(games) <= 0:
+                messages.append("No deals available right now")
+            else:
+                messages.extend(pack_messages([g.to_string(True) for g in games]))
+        messages.append("<b>ΛΛΛ {} ΛΛΛ</b>".format(bundle.name))
+    return messages
+
+
 def send_bundles(bot, tid, bundles):
+    global send_queue
     try:
-        for bundle in bundles:
-            bot.send_message(chat_id=tid, parse_mode=ParseMode.HTML, text='<b>VVV</b> <a href="{}">{}</a> <b>VVV</b>'.format(bundle.url, bundle.name))
-            for grp in bundle.gameGroups.keys():
-                bot.send_message(chat_id=tid, parse_mode=ParseMode.HTML, text='<i>{}</i>'.format(grp))
-                send_deals(bot, tid, bundle.gameGroups[grp])
-            bot.send_message(chat_id=tid, parse_mode=ParseMode.HTML, text="<b>ΛΛΛ {} ΛΛΛ</b>".format(bundle.name))
+        send_queue.send_messages(tid, render_bundles(bundles), parse_mode=ParseMode.HTML)
     except TelegramError as e:
         logging.error("error %s\nwhile sending bundles to %s", e, tid)
 
+
+# games in the new cache that were not there before or changed price
+def get_changed_games(old_cache, new_cache):
+    old = {g.gid: (g.price, g.cut) for g in old_cache}
+    return [g for g in new_cache if old.get(g.gid) != (g.price, g.cut)]
+
+
+# pushes price changes to the other users caching the same games, following their settings;
+# the pushed price is excluded so that the daily update doesn't send it again
+def notify_subscribers(bot, games, source_tid=None):
+    global subscribers, user_data_manager
+    pending = {}
+    for g in games:
+        for tid in subscribers.match_game(g):
+            if tid != source_tid:
+                pending.setdefault(tid, []).append(g)
+
+    for tid, tgames in pending.items():
+        def push(ud):
+            send_deals(bot, ud.tid, tgames)
+            exclude = ud.get_exclude_map()
+            for g in tgames:
+                exclude[g.gid] = g.price
+            ud.exclude_list = [Exclude(gid, price) for gid, price in exclude.items()]
+
+        ud = user_data_manager.update_userdata(tid, push)
+        if ud is None:
+            subscribers.remove_user(tid)
+            continue
+        subscribers.add_user(ud)
+
+    if len(pending) > 0:
+        logging.info("pushed {} changed games to {} users".format(len(games), len(pending)))
+
+
+# runs notify_subscribers on the push thread, so that refreshes complete without waiting for the pushes
+def start_notify_subscribers(bot, games, source_tid=None):
+    global push_executor
+
+    def run():
+        try:
+            notify_subscribers(bot, games, source_tid)
+        except Exception as e:
+            logging.error("error %s\nwhile pushing changes of %s", e, source_tid)
+
+    if len(games) > 0:
+        push_executor.submit(run)
+
+# (re)loads the local steam app index when the app list file changed
+def load_steam_apps():
+    global steam_apps_file, steam_apps_mtime
+    if not os.path.isfile(steam_apps_file):
+        return
+    mtime = os.path.getmtime(steam_apps_file)
+    if mtime == steam_apps_mtime:
+        return
+    try:
+        start = time.time()
+        steam_deallist.app_index = SteamAppIndex.load(steam_apps_file)
+        steam_apps_mtime = mtime
+        logging.info("loaded {} steam apps in {:.1f}s".format(len(steam_deallist.app_index), time.time() - start))
+    except Exception as e:
+        logging.error("invalid steam app list {}: {}".format(steam_apps_file, e))
+
+def edit_message(bot, tid, message_id, text, send_on_error=False):
+    try:
+        bot.edit_message_text(chat_id=tid, message_id=message_id, text=text)
+    except TelegramError as e:
+        if send_on_error:
+            bot.send_message(chat_id=tid, text=text)
+
+
+# stores the refreshed wishlist cache of username for tid, pushing its price changes to the other users
+def store_user_cache(bot, tid, username, cache):
+    global user_data_manager, subscribers
+    old_cache = []
+
+    def apply(ud):
+        if ud.username != username:
+            logging.info("discarding cache of {} for {}, username changed to {}".format(username, tid, ud.username))
+            return False
+        old_cache.extend(ud.cache)
+        ud.cache = list(cache)
+        ud.updated = time.time()
+
+    ud = user_data_manager.update_userdata(tid, apply)
+    if ud is None or ud.username != username:
+        return
+    subscribers.add_user(ud)
+    start_notify_subscribers(bot, get_changed_games(old_cache, ud.cache), tid)
+
+
+# refreshes the cache of a stored user in background, requests for a tid or steam username already
+# being refreshed join the running job; the returned Refresh completes once the cache is stored
+def start_user_refresh(bot, user_data):
+    global refreshes
+    tid = user_data.tid
+    username = user_data.username
+
+    def run(refresh):
+        cache = steam_deallist.get_updated_user_cache(user_data, progress=refresh.progress)
+        store_user_cache(bot, tid, username, cache)
+        httpcache.cache.store()
+        return cache
+
+    def store(cache, error):
+        if error is None:
+            store_user_cache(bot, tid, username, cache)
+
+    keys = [('tid', tid), ('user', username)]
+    refresh, started = refreshes.submit(keys, run)
+    if not started and ('tid', tid) in refresh.keys and ('user', username) not in refresh.keys:
+        # running refresh of the username tid had before changing it
+        logging.info("queueing cache refresh for {} after the running one".format(tid))
+        refresh = refreshes.submit_after(refresh, keys, run)
+    elif not started:
+        logging.info("joining running cache refresh for {}".format(tid))
+        if ('tid', tid) not in refresh.keys:
+            # refresh of another user with the same steam username
+            refresh.when_done(store)
+    return refresh
+
+
+# refreshes the cache of a stored user, editing message_id with the progress and then with done_text
+def refresh_user_cache(bot, user_data, message_id, working_text, done_text):
+    tid = user_data.tid
+
+    def done(cache, error):
+        if error is not None:
+            logging.error("error %s\nwhile refreshing cache for %s", error, tid)
+            edit_message(bot, tid, message_id, "Could not update local cache, please retry later", True)
+            return
+        edit_message(bot, tid, message_id, done_text, True)
+
+    refresh = start_user_refresh(bot, user_data)
+    refresh.listen(lambda status: edit_message(bot, tid, message_id, "{}\n{}".format(working_text, status)))
+    refresh.when_done(done)
+
+
+# after answering from a cache older than the freshness window, refreshes it in background and tells
+# the user to ask again if query, run on the refreshed data, gives a different list than the one sent
+def revalidate_user_cache(bot, user_data, games, query, command):
+    global user_data_manager, send_queue, cache_freshness
+    age = user_data.cache_age()
+    if age is not None and age < cache_freshness:
+        return
+    tid = user_data.tid
+    sent = {(g.gid, g.price) for g in games}
+
+    def done(cache, error):
+        if error is not None:
+            logging.error("error %s\nwhile revalidating cache for %s", error, tid)
+            return
+        ud = user_data_manager.get_userdata(tid)
+        if ud is None:
+            return
+        current = {(g.gid, g.price) for g in query(ud)}
+        if current != sent:
+            send_queue.send_message(tid, "Prices changed since this list was sent ({} new, {} gone), "
+                                         "ask again for the updated {}".format(len(current - sent),
+                                                                               len(sent - current), command))
+
+    logging.info("cache of {} is stale, revalidating".format(tid))
+    start_user_refresh(bot, user_data).when_done(done)
+
 # #### COMMANDS ####
 
 def comm_deals(bot, update):
@@ -73,9 +281,12 @@ def comm_deals(bot, update):
         return
 
     try:
-        send_deals(bot, user_data.tid, steam_deallist.get_discount_games(user_data))
+        games = steam_deallist.get_discount_games(user_data)
+        send_deals(bot, user_data.tid, games)
     except TelegramError as e:
         logging.error(e)
+        return
+    revalidate_user_cache(bot, user_data, games, steam_deallist.get_discount_games, "/deals")
 
 
 def comm_stats(bot, update):
@@ -90,7 +301,7 @@ def comm_stats(bot, update):
     bot.send_message(chat_id=update.message.chat_id, text=stats)
 
 
-def comm_update(bot, update, user_data=None, send_message=True):
+def comm_update(bot, update, user_data=None):
     global user_data_manager
     if user_data is None:
         user_data = user_data_manager.get_userdata(update.message.chat_id)
@@ -99,18 +310,9 @@ def comm_update(bot, update, user_data=None, send_message=True):
         bot.send_message(chat_id=update.message.chat_id, text="Account not configured! Please, issue /start command")
         return
 
-    if send_message:
-        update_message = bot.send_message(chat_id=update.message.chat_id, reply_markup=ReplyKeyboardRemove(),
-                                      text="Updating local cache...⏳")
-    user_data.cache = steam_deallist.get_updated_user_cache(user_data)
-    user_data_manager.store_userdata(user_data)
-    if send_message:
-        try:
-            bot.edit_message_text(chat_id=update.message.chat_id, message_id=update_message.message_id, text="Local cache updated")
-        except TelegramError as e:
-            bot.send_message(chat_id=update.message.chat_id, text="Local cache updated")
-            update_message = None
-        return update_message
+    text = "Updating local cache...⏳"
+    update_message = bot.send_message(chat_id=update.message.chat_id, reply_markup=ReplyKeyboardRemove(), text=text)
+    refresh_user_cache(bot, user_data, update_message.message_id, text, "Local cache updated")
 
 
 def comm_all_deals(bot, update):
@@ -122,6 +324,7 @@ def comm_all_deals(bot, update):
         return
 
     send_deals(bot, update.message.chat_id, user_data.cache)
+    revalidate_user_cache(bot, user_data, user_data.cache, lambda ud: ud.cache, "/alldeals")
 
 
 def comm_bundles(bot, update):
@@ -225,15 +428,10 @@ def conv_start_confirm(bot, update, user_data):
                "/update deals information, change /settings or show you some /stats. " \
                 "I can provide you more info if you aske me for /help. " \
                 "\n\nI am an open source bot, find me on https://github.com/mellotanica/steam_deallist".format(ud.username)
+        user_data_manager.store_userdata(ud)
         um = bot.send_message(chat_id=update.message.chat_id, reply_markup=ReplyKeyboardRemove(),
                               text="Initializing cache..⏳")
-        comm_update(bot, update, ud, False)
-        try:
-            bot.edit_message_text(text, chat_id=update.message.chat_id, message_id=um.message_id)
-        except TelegramError as e:
-            bot.send_message(text=text, chat_id=update.message.chat_id)
-
-        user_data_manager.store_userdata(ud)
+        refresh_user_cache(bot, ud, um.message_id, "Initializing cache..⏳", text)
         return ConversationHandler.END
     elif repl in 'no':
         bot.send_message(chat_id=update.message.chat_id, reply_markup=ReplyKeyboardRemove(),
@@ -282,7 +480,7 @@ def conv_settings_start(bot, update, user_data):
 
 
 def conv_settings_set(bot, update, user_data):
-    global user_data_manager
+    global user_data_manager, subscribers
 
     text = update.message.text.lower()
 
@@ -310,11 +508,23 @@ def conv_settings_set(bot, update, user_data):
         user_data['current_param'] = __settings_humble_bundle_enabled
         ret = 2
     elif text in "done" or text in "cancel":
-        user_data_manager.store_userdata(user_data['ud'])
+        settings = user_data['ud']
+
+        # only the settings, the cache may have been refreshed since the conversation started
+        def apply(ud):
+            ud.username = settings.username
+            ud.configs = settings.configs
+
+        ud = user_data_manager.update_userdata(update.message.chat_id, apply)
+        if ud is None:
+            bot.send_message(chat_id=update.message.chat_id, reply_markup=ReplyKeyboardRemove(),
+                             text="Account not configured! Please, issue /start command")
+            return ConversationHandler.END
+        subscribers.add_user(ud)
         bot.send_message(chat_id=update.message.chat_id, reply_markup=ReplyKeyboardRemove(),
                          text="Settings modified.")
-        if user_data['original_user'] != user_data['ud'].username:
-            comm_update(bot, update, user_data['ud'])
+        if user_data['original_user'] != ud.username:
+            comm_update(bot, update, ud)
         return ConversationHandler.END
     else:
         ret = 0
@@ -517,30 +727,97 @@ def conv_cancel(bot, update):
 
 # #### JOBS ####
 
-def job_deals(bot, job):
-    global user_data_manager
+def update_user_deals(bot, tid, snapshot):
+    global user_data_manager, subscribers
 
-    logging.info("updating local caches")
+    ud = user_data_manager.get_userdata(tid)
+    if ud is None:
+        return []
+    username = ud.username
+    logging.info("updating cache for tid {}, user {}".format(ud.tid, username))
+
+    cache = steam_deallist.get_updated_user_cache(ud, snapshot)
+
+    # the user may have changed settings or excludes while the cache was fetched
+    def apply(ud):
+        if ud.username != username:
+            logging.info("discarding cache of {} for {}, username changed to {}".format(username, tid, ud.username))
+            return False
+        ud.cache = cache
+        ud.updated = time.time()
+
+        games = steam_deallist.get_discount_games(ud, ignore_excludes=False)
+        if len(games) > 0:
+            send_deals(bot, ud.tid, games)
+
+        ud.set_exclude_cache()
+
+    ud = user_data_manager.update_userdata(tid, apply)
+    if ud is None:
+        return []
+    subscribers.add_user(ud)
+    return [g.gid for g in ud.cache]
 
-    for tid in user_data_manager.get_userlist():
-        ud = user_data_manager.get_userdata(tid)
-        if ud is not None:
-            logging.info("updating cache for tid {}, user {}".format(ud.tid, ud.username))
 
-            ud.cache = steam_deallist.get_updated_user_cache(ud)
+# returns the ids of games cached for the user (None on failure) and the time spent
+def timed_update_user_deals(bot, tid, snapshot):
+    start = time.time()
+    try:
+        gids = update_user_deals(bot, tid, snapshot)
+    except Exception as e:
+        logging.error("error %s\nwhile updating deals for %s", e, tid)
+        gids = None
+    return gids, time.time() - start
 
-            games = steam_deallist.get_discount_games(ud, ignore_excludes=False)
-            if len(games) > 0:
-                send_deals(bot, ud.tid, games)
 
-            ud.set_exclude_cache()
-            user_data_manager.store_userdata(ud)
+def job_deals(bot, job):
+    global user_data_manager, update_workers, game_catalog
+
+    logging.info("updating local caches")
+    start = time.time()
+
+    # the snapshot is shared among workers, so that market prices are fetched once per game
+    snapshot = None
+    api_key = steam_deallist.get_itad_api_key()
+    if api_key is not None:
+        snapshot = isthedeal_wrapper.PriceSnapshot(api_key)
+
+    latencies = []
+    failures = 0
+    cached = set()
+    with ThreadPoolExecutor(max_workers=update_workers) as executor:
+        futures = [executor.submit(timed_update_user_deals, bot, tid, snapshot)
+                   for tid in user_data_manager.get_userlist()]
+        for fut in as_completed(futures):
+            gids, latency = fut.result()
+            latencies.append(latency)
+            if gids is None:
+                failures += 1
+            else:
+                cached.update(gids)
+
+    latencies.sort()
+    if len(latencies) > 0:
+        logging.info("daily update done in {:.1f}s: {} users, {} failed, per user latency "
+                     "avg {:.1f}s, p95 {:.1f}s, max {:.1f}s".format(
+                         time.time() - start, len(latencies), failures, sum(latencies) / len(latencies),
+                         latencies[int(0.95 * (len(latencies) - 1))], latencies[-1]))
+    else:
+        logging.info("daily update done, no users")
+    logging.info("user data cache: {}".format(user_data_manager.get_stats()))
 
-    logging.info("daily update done")
+    # games of users that failed the update are still referenced, games used since start
+    # may belong to users stored outside of the job (/start, /update, revalidations)
+    if failures == 0:
+        logging.info("removed {} games from catalog".format(game_catalog.prune(cached, start)))
+    game_catalog.store(True)
+    httpcache.cache.store()
 
 
 def job_bundles(bot, job):
-    global bundle_cache_file, bundles_cache, user_data_manager
+    global bundle_cache_file, bundles_cache, user_data_manager, broadcasts, send_queue
+
+    load_steam_apps()
 
     if bundles_cache is None or bundles_cache.is_outdated():
         logging.info("updating bundles cache")
@@ -554,17 +831,29 @@ def job_bundles(bot, job):
         for bundle in bundles_cache.get_new_bundles():
             notified.append(bundle)
 
-        for tid in user_data_manager.get_userlist():
-            ud = user_data_manager.get_userdata(tid)
-            if ud is not None and ud.configs.humble_bundle_enabled:
-                send_bundles(bot, tid, notified)
+        if len(notified) > 0:
+            recipients = []
+            for tid in user_data_manager.get_userlist():
+                ud = user_data_manager.get_userdata(tid)
+                if ud is not None and ud.configs.humble_bundle_enabled:
+                    recipients.append(tid)
 
-        bundles_cache.notified_bundles(notified)
+            # once the broadcast is stored, delivery survives restarts
+            b = broadcasts.create("bundles", render_bundles(notified), recipients, ParseMode.HTML)
+            bundles_cache.notified_bundles(notified)
+            b.run(send_queue)
 
+        httpcache.cache.store()
         logging.info("bundles cache updated")
 
+def job_regions(bot, job):
+    if not isthedeal_wrapper.refresh_regions():
+        logging.warning("could not refresh regions table")
+    httpcache.cache.store()
+
+
 def job_sporadic_notify(bot, job):
-    global user_data_manager, env_vars
+    global user_data_manager, env_vars, broadcasts, send_queue
 
     if env_vars['notification_file'] in os.environ:
         if os.path.exists(os.environ[env_vars['notification_file']]):
@@ -575,19 +864,94 @@ def job_sporadic_notify(bot, job):
             os.rename(os.environ[env_vars['notification_file']], os.environ[env_vars['notification_file']]+"_done")
             if content is not None and len(content) > 0:
                 logging.info("notifying message:\n{}".format(content))
-                for tid in user_data_manager.get_userlist():
-                    bot.send_message(chat_id=tid, parse_mode=ParseMode.HTML, text=content)
+                b = broadcasts.create("notification", [content], user_data_manager.get_userlist(), ParseMode.HTML)
+                b.run(send_queue)
+
+
+def job_subscribers(bot, job):
+    global user_data_manager, subscribers
+    start = time.time()
+    for tid in user_data_manager.get_userlist():
+        ud = user_data_manager.get_userdata(tid)
+        if ud is not None:
+            subscribers.add_user(ud)
+    logging.info("subscribers index built in {:.1f}s, {} users".format(time.time() - start, len(subscribers)))
+
+
+def job_resume_broadcasts(bot, job):
+    global broadcasts, send_queue
+    broadcasts.resume_all(send_queue)
 
 
 # #### BOT INITIALIZATION ####
 
-user_data_manager = UserDataManager(tid_cache_dir)
+# wishlist games are shared among users of file based backends
+game_catalog = GameCatalog(catalog_file)
+atexit.register(game_catalog.store, True)
+
+userdata_backend = os.environ.get(optional_env_vars['userdata_backend'])
+if userdata_backend == "sqlite":
+    migrate = not os.path.isfile(userdata_db_file)
+    user_data_manager = SqliteUserDataManager(userdata_db_file)
+    if migrate:
+        user_data_manager.migrate_from_dir(tid_cache_dir, game_catalog)
+elif userdata_backend == "journal":
+    user_data_manager = JournaledUserDataManager(tid_cache_dir, catalog=game_catalog)
+else:
+    user_data_manager = UserDataManager(tid_cache_dir, os.environ.get(optional_env_vars['userdata_encoding'], 'json'),
+                                        game_catalog)
+
+user_data_cache_size = None
+if optional_env_vars['userdata_cache_size'] in os.environ:
+    user_data_cache_size = int(os.environ[optional_env_vars['userdata_cache_size']])
+user_data_manager = CachedUserDataManager(user_data_manager, user_data_cache_size)
 bundles_cache = None
+# game id -> interested users, filled in background at startup
+subscribers = SubscriberIndex()
+broadcasts = BroadcastManager(broadcasts_dir)
+
+http_cache_size = 64
+if steam_deallist.optional_vars['http_cache_size'] in os.environ:
+    http_cache_size = int(os.environ[steam_deallist.optional_vars['http_cache_size']])
+httpcache.cache = httpcache.HttpCache(http_cache_dir, http_cache_size * 1024 * 1024)
+atexit.register(httpcache.cache.store)
+
+# steam ids never change plain, unresolved ones are retried after a day
+isthedeal_wrapper.plain_cache = PersistentCache(plain_cache_file, ttl=90*24*3600, negative_ttl=24*3600)
+isthedeal_wrapper.plain_cache.purge()
+
+# bundle titles resolved on the steam store, titles without a match are searched again after a few days
+steam_deallist.search_cache = PersistentCache(search_cache_file, ttl=30*24*3600, negative_ttl=3*24*3600)
+steam_deallist.search_cache.purge()
+
+# modification time of the loaded steam app list, the index is built by the bundles job
+steam_apps_mtime = None
+
+# regions are read from disk, the table is refreshed in background
+isthedeal_wrapper.load_regions(regions_file)
 
 telegram_token = os.environ[env_vars['telegram_token']]
 update_h = int(os.environ[env_vars['update_h']])
 update_m = int(os.environ[env_vars['update_m']])
 
+# number of users refreshed in parallel by the daily job
+update_workers = 4
+if optional_env_vars['update_workers'] in os.environ:
+    update_workers = max(1, int(os.environ[optional_env_vars['update_workers']]))
+
+# number of /update requests served in parallel, in background of the telegram handlers
+refresh_workers = 2
+if optional_env_vars['refresh_workers'] in os.environ:
+    refresh_workers = max(1, int(os.environ[optional_env_vars['refresh_workers']]))
+refreshes = RefreshManager(refresh_workers)
+# a single thread pushing price changes found by refreshes, pushes are paced by send_queue anyway
+push_executor = ThreadPoolExecutor(max_workers=1)
+
+# seconds a user cache is answered from before being refreshed in background by /deals and /alldeals
+cache_freshness = 12 * 3600
+if optional_env_vars['cache_freshness'] in os.environ:
+    cache_freshness = float(os.environ[optional_env_vars['cache_freshness']]) * 3600
+
 update_time = None
 if 0 <= update_h < 24 and 0 <= update_m < 60:
     update_time = datetime.time(update_h, update_m)
@@ -599,6 +963,9 @@ logging.info("logger initialized")
 updater = Updater(token=telegram_token)
 dispatcher = updater.dispatcher
 
+# every notification goes through the same queue, paced under telegram flood limits
+send_queue = SendQueue(updater.bot)
+
 # register telegram callbacks
 
 dispatcher.add_handler(CommandHandler("deals", comm_deals))
@@ -641,6 +1008,15 @@ if update_time is not None:
 if update_time is not None:
     logging.info("will send updates each day at {}".format(update_time))
 
+# finish broadcasts interrupted by a previous run, before anything new is sent
+updater.job_queue.run_once(job_resume_broadcasts, 0)
+
+# index users by cached game, for price change notifications
+updater.job_queue.run_once(job_subscribers, 0)
+
+# refresh regions table in background once a day
+updater.job_queue.run_repeating(job_regions, datetime.timedelta(days=1), first=0)
+
 # init bundles cache in background
 updater.job_queue.run_once(job_bundles, datetime.datetime.now())
 
@@ -2,21 +2,65 @@
 
 import os
 from bs4 import BeautifulSoup
-import urllib.request
 import urllib.parse
-from isthedeal_wrapper import get_multiple_games_lowest_prices
+import httpcache
+from isthedeal_wrapper import PriceSnapshot
 from userdata import UserData, Game
 import re
 import editdistance
 import json
+import logging
 
 optional_vars = {
-    'isthereanydeal_api_key': 'ISTHEREANYDEAL_API_KEY'
+    'isthereanydeal_api_key': 'ISTHEREANYDEAL_API_KEY',
+    'http_cache_size': 'HTTP_CACHE_SIZE_MB',
+    'deal_max_age': 'DEAL_MAX_AGE_HOURS'
 }
 
+DEAL_MAX_AGE_DEFAULT = 72
 
-def __sanitize_price_string(price):
-    return price.replace(",",".").replace("-", "0")
+
+__discount_fields = {
+    name: re.compile(r'class="[^"]*\b' + name + r'\b[^"]*"[^>]*>([^<]*)<')
+    for name in ("discount_original_price", "discount_final_price", "discount_pct")
+}
+__price_number = re.compile(r"\d[\d.,'\s\u00a0-]*")
+__price_separators = re.compile(r"[.,'\s\u00a0]")
+
+
+# parses a localized steam price ("19,99€", "$1,299.99", "19,--€", "₩ 19 000") into a float
+def parse_price(text):
+    m = __price_number.search(text)
+    if m is None:
+        return None
+    number = m.group().strip().replace("-", "0")
+    # the last separator is a decimal point only if followed by one or two digits
+    decimals = ""
+    last = max(number.rfind("."), number.rfind(","))
+    if last >= 0 and 0 < len(number) - last - 1 <= 2 and number[last+1:].isdigit():
+        decimals = number[last+1:]
+        number = number[:last]
+    number = __price_separators.sub("", number)
+    if len(decimals) > 0:
+        number += "." + decimals
+    return float(number)
+
+
+# extracts (original price, final price, cut) from a discount_block snippet, None if the markup is unknown
+def parse_discount_block(block):
+    fields = {}
+    for name, pattern in __discount_fields.items():
+        m = pattern.search(block)
+        if m is None:
+            return None
+        fields[name] = m.group(1)
+
+    original_price = parse_price(fields["discount_original_price"])
+    final_price = parse_price(fields["discount_final_price"])
+    cut = parse_price(fields["discount_pct"])
+    if original_price is None or final_price is None or cut is None:
+        return None
+    return original_price, final_price, int(cut)
 
 
 def __is_game_applicable(g, max_price, low_price_discount, min_discount, exclude):
@@ -32,12 +76,55 @@ def __is_game_applicable(g, max_price, low_price_discount, min_discount, exclude
     return False
 
 
-def get_updated_user_cache(user_data):
-    if type(user_data) is not UserData:
-        raise Exception("user_data must be a valid UserData object")
+def get_itad_api_key():
+    return os.environ.get(optional_vars['isthereanydeal_api_key'])
+
+
+# maximum age in seconds of a stored Deal that can be reused for an unchanged game
+def get_deal_max_age():
+    hours = DEAL_MAX_AGE_DEFAULT
+    if optional_vars['deal_max_age'] in os.environ:
+        hours = float(os.environ[optional_vars['deal_max_age']])
+    return hours * 3600
+
+
+__wishlist_max_pages = 100
+
+
+def __read_json(url):
+    j, modified = httpcache.fetch_json(url)
+    if j is None:
+        raise Exception("could not read {}".format(url))
+    return j
 
-    url = "http://steamcommunity.com/id/{}/wishlist".format(user_data.username)
-    soup = BeautifulSoup(urllib.request.urlopen(url), "lxml")
+
+def __read_page(url):
+    body, modified = httpcache.fetch(url)
+    if body is None:
+        raise Exception("could not read {}".format(url))
+    return BeautifulSoup(body, "lxml")
+
+
+# reads the paginated wishlistdata endpoint directly, raises an Exception if steam refuses the request
+def __get_wishlist_json(username):
+    data = {}
+    for page in range(__wishlist_max_pages):
+        url = "https://store.steampowered.com/wishlist/id/{}/wishlistdata/?p={}".format(
+            urllib.parse.quote(username, safe=''), page)
+        j = __read_json(url)
+        # an empty page is returned as an empty list
+        if type(j) is not dict or len(j) <= 0:
+            break
+        if 'success' in j:
+            raise Exception("wishlistdata request failed with code {}".format(j['success']))
+        data.update(j)
+    return data
+
+
+# scrapes the community wishlist page looking for the embedded app info and wishlistdata url
+def __get_wishlist_html(username):
+    url = "http://steamcommunity.com/id/{}/wishlist".format(username)
+    soup = __read_page(url)
 
     data = None
     second_url = None
@@ -55,8 +142,25 @@ def get_updated_user_cache(user_data):
             break
 
     if second_url is not None:
-        req = urllib.request.urlopen(second_url)
-        data.update(json.loads(req.read().decode(req.info().get_content_charset('utf-8'))))
+        data.update(__read_json(second_url))
+
+    return data
+
+
+def get_wishlist_data(username):
+    try:
+        return __get_wishlist_json(username)
+    except Exception as e:
+        logging.warning("wishlistdata fetch failed for {} ({}), scraping wishlist page".format(username, e))
+    return __get_wishlist_html(username)
+
+
+# returns a {game_id: Game} dictionary of discounted wishlist games, without market information
+def get_wishlist_discount_games(user_data):
+    if type(user_data) is not UserData:
+        raise Exception("user_data must be a valid UserData object")
+
+    data = get_wishlist_data(user_data.username)
 
     discount_games = {}
 
@@ -69,31 +173,69 @@ def get_updated_user_cache(user_data):
                 prc = s["price"]
 
         if sub is not None:
-            db = BeautifulSoup(sub["discount_block"], "lxml")
-            original_price = float(__sanitize_price_string(db.find("div", "discount_original_price").text[:-1]))
-            final_price = float(__sanitize_price_string(db.find("div", "discount_final_price").text[:-1]))
-            cut = int(float(__sanitize_price_string(db.find("div", "discount_pct").text[1:-1])))
+            prices = parse_discount_block(sub["discount_block"])
+            if prices is None:
+                logging.warning("unknown discount block for {}: {}".format(game["name"], sub["discount_block"]))
+                continue
+            original_price, final_price, cut = prices
             name = game["name"]
             tokens = game["capsule"].split('/')
             gameid = "app/"+tokens[-2]
             link = "http://store.steampowered.com/" + gameid
             discount_games[gameid] = (Game(gameid, original_price, final_price, cut, link, name, None))
 
-    if optional_vars['isthereanydeal_api_key'] in os.environ:
-        id_list = [g.gid for g in discount_games.values()]
+    return discount_games
+
+
+# copies the stored Deal of games whose steam price and cut did not change since the last refresh,
+# returns the ids of games that need a new price lookup
+def reuse_cached_deals(user_data, discount_games, max_age=None):
+    if max_age is None:
+        max_age = get_deal_max_age()
+
+    previous = {g.gid: g for g in user_data.cache}
+    missing = []
+    for g in discount_games.values():
+        if g.deal is not None:
+            continue
+        p = previous.get(g.gid)
+        if p is not None and p.deal is not None and p.price == g.price and p.cut == g.cut \
+                and p.deal.age() < max_age:
+            g.deal = p.deal
+        else:
+            missing.append(g.gid)
+    return missing
+
+
+# snapshot is an optional PriceSnapshot shared among users in the same update cycle,
+# progress, if given, is called with a short description of each step
+def get_updated_user_cache(user_data, snapshot=None, discount_games=None, progress=None):
+    if discount_games is None:
+        if progress is not None:
+            progress("Reading {} wishlist".format(user_data.username))
+        discount_games = get_wishlist_discount_games(user_data)
+
+    missing = reuse_cached_deals(user_data, discount_games)
 
-        deals = get_multiple_games_lowest_prices(os.environ[optional_vars['isthereanydeal_api_key']], id_list)
+    api_key = get_itad_api_key()
+    if snapshot is None and api_key is not None and len(missing) > 0:
+        snapshot = PriceSnapshot(api_key)
 
-        if deals is not None:
-            for d in deals:
-                if d.game_id in discount_games:
-                    discount_games[d.game_id].deal = d
+    if snapshot is not None:
+        if progress is not None and len(missing) > 0:
+            progress("Fetching prices for {} of {} discounted games".format(len(missing), len(discount_games)))
+        snapshot.update(missing)
+        for gid in missing:
+            discount_games[gid].deal = snapshot.get(gid)
 
-    return discount_games.values()
+    return list(discount_games.values())
 
 
+# at_historical_low and cheaper_elsewhere further restrict results to games at their
+# historical low price or sold for less on another shop
 def get_discount_games(user_data, max_price=None, low_price_discount=None,
-                       min_discount=None, ignore_excludes=True, include_recommended=None):
+                       min_discount=None, ignore_excludes=True, include_recommended=None,
+                       at_historical_low=False, cheaper_elsewhere=False):
     if type(user_data) is not UserData:
         raise Exception("user_data must be a valid UserData object")
 
@@ -113,10 +255,8 @@ def get_discount_games(user_data, max_price=None, low_price_discount=None,
     if include_recommended is None:
         include_recommended = user_data.configs.show_best_deals
 
-    applicable_games = [g for g in user_data.cache if g.is_applicable(
-        max_price, low_price_discount, min_discount, exclude, include_recommended)]
-
-    return applicable_games
+    return user_data.get_index().query(max_price, low_price_discount, min_discount, exclude, include_recommended,
+                                       at_historical_low, cheaper_elsewhere)
 
 
 def get_id_from_store_url(link):
@@ -125,13 +265,52 @@ def get_id_from_store_url(link):
 
 __clean_spaces = re.compile(r"\s+")
 
-def query_steam_for_game(name):
+
+# optional ttlcache.PersistentCache of {normalized title: [game id, link]} used by query_steam_for_game,
+# titles that matched nothing are stored as negative entries
+search_cache = None
+
+# optional steamapps.SteamAppIndex tried by query_steam_for_game before searching the store
+app_index = None
+
+
+def normalize_title(name):
     global __clean_spaces
     name = __clean_spaces.sub(" ", name)
     if name.endswith(" Standard Edition"):
         name = name[:-len(" Standard Edition")]
+    return name
+
+
+# returns a (game id, link) tuple for the closest match in the local app index or among steam
+# search results, (None, None) if nothing matched
+def query_steam_for_game(name):
+    name = normalize_title(name)
+    if app_index is not None:
+        gid, link = app_index.match(name)
+        if gid is not None:
+            return gid, link
+
+    if search_cache is not None:
+        found, match = search_cache.get(name)
+        if found:
+            if match is None:
+                return None, None
+            return match[0], match[1]
+
+    gid, link = __search_steam(name)
+    if search_cache is not None:
+        if gid is None:
+            search_cache.put(name, None)
+        else:
+            search_cache.put(name, [gid, link])
+    return gid, link
+
+
+def __search_steam(name):
+    global __clean_spaces
     url = "http://store.steampowered.com/search/?term=" + urllib.parse.quote(name, safe='')
-    soup = BeautifulSoup(urllib.request.urlopen(url), "lxml")
+    soup = __read_page(url)
     minedit = None
     link = None
 
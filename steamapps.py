@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import json
+import logging
+import editdistance
+from array import array
+from collections import Counter
+import httpcache
+from atomicfile import atomic_write
+
+APP_LIST_URL = "https://api.steampowered.com/ISteamApps/GetAppList/v2/"
+
+# same threshold used on steam search results
+MAX_DISTANCE = 4
+
+__clean_spaces = re.compile(r"\s+")
+
+
+def clean_name(name):
+    global __clean_spaces
+    return __clean_spaces.sub(" ", name).strip()
+
+
+# edits allowed between a title and an app name: the whole app list is searched, not relevance
+# ranked results, so short titles must match exactly, a few edits turn them into unrelated apps
+def max_distance(name):
+    return min(MAX_DISTANCE - 1, len(name) // 5)
+
+
+def trigrams(name):
+    name = "  {} ".format(name.lower())
+    return set(name[i:i+3] for i in range(len(name) - 2))
+
+
+# offline fuzzy matching of titles against the steam app list: candidates are the apps
+# sharing enough trigrams with the title, then compared with the edit distance allowed for its length
+class SteamAppIndex:
+    def __init__(self, apps):
+        # lowest app id first, so that base games win over duplicates with the same name
+        apps = sorted((a for a in apps if a[1] is not None and len(a[1]) > 0), key=lambda a: a[0])
+        self.ids = [a[0] for a in apps]
+        self.names = [a[1] for a in apps]
+        # {lowercase name: position of the first app with that name}
+        self.exact = {}
+        # {(trigram, name length): array of app positions}, close names differ
+        # in length by at most max_distance so only a few lengths are looked up
+        self.postings = {}
+        for i, name in enumerate(self.names):
+            self.exact.setdefault(name.lower(), i)
+            for t in trigrams(name):
+                key = (t, len(name))
+                p = self.postings.get(key)
+                if p is None:
+                    p = array('i')
+                    self.postings[key] = p
+                p.append(i)
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def load(path):
+        f = open(path, 'r')
+        try:
+            apps = json.load(f)['applist']['apps']
+        finally:
+            f.close()
+        return SteamAppIndex([(a['appid'], clean_name(a['name'])) for a in apps])
+
+    def __result(self, i):
+        return "app/{}".format(self.ids[i]), "https://store.steampowered.com/app/{}/".format(self.ids[i])
+
+    # returns a (game id, link) tuple for the closest app name, (None, None) if none is close enough
+    # and the caller has to fall back to the store search
+    def match(self, name):
+        allowed = max_distance(name)
+        i = self.exact.get(name.lower())
+        if i is not None and editdistance.eval(name, self.names[i]) <= allowed:
+            return self.__result(i)
+        if allowed == 0:
+            return None, None
+
+        grams = trigrams(name)
+        # an edit changes at most 3 trigrams, so a close enough name shares all but 3 * allowed
+        # of them, and at least half
+        required = max(len(grams) - 3 * allowed, (len(grams) + 1) // 2)
+        shared = Counter()
+        for l in range(max(1, len(name) - allowed), len(name) + allowed + 1):
+            for t in grams:
+                p = self.postings.get((t, l))
+                if p is not None:
+                    shared.update(p)
+
+        best = None
+        mindist = allowed + 1
+        for i in sorted(i for i, n in shared.items() if n >= required):
+            distance = editdistance.eval(name, self.names[i])
+            if distance < mindist:
+                best = i
+                mindist = distance
+
+        if best is None:
+            return None, None
+        return self.__result(best)
+
+
+# downloads the steam app list to path, to be run out of band to refresh the local index
+def download(path):
+    body, modified = httpcache.fetch(APP_LIST_URL)
+    if body is None:
+        raise Exception("could not download steam app list")
+    apps = json.loads(body.decode('utf-8'))['applist']['apps']
+    atomic_write(path, body)
+    return len(apps)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("usage: {} APPS_FILE".format(sys.argv[0]))
+        exit(1)
+    logging.basicConfig(level=logging.INFO)
+    logging.info("downloaded {} apps to {}".format(download(sys.argv[1]), sys.argv[1]))
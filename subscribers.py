@@ -0,0 +1,99 @@
+import threading
+from bisect import bisect_left
+
+
+# users interested in a game, sorted by max price so that a price update splits
+# them in three bands that can be matched without looking at every user:
+#   max_price < price                  -> need min_discount (or a recommended deal)
+#   price <= max_price < original      -> always notified
+#   max_price >= original and price    -> need low_price_min_discount
+class Subscribers:
+    def __init__(self, entries):
+        entries = sorted(entries, key=lambda e: e[1])
+        self.tids = [e[0] for e in entries]
+        self.max_prices = [e[1] for e in entries]
+        self.min_discounts = [e[2] for e in entries]
+        self.low_price_discounts = [e[3] for e in entries]
+        self.show_best_deals = [e[4] for e in entries]
+        # {price: {tid}} of users that already know the game at that price
+        self.excluded = {}
+
+    def match(self, price, original_price, cut, recommended):
+        k1 = bisect_left(self.max_prices, price)
+        k2 = max(k1, bisect_left(self.max_prices, original_price))
+
+        if recommended:
+            out = [t for t, md, sbd in zip(self.tids[:k1], self.min_discounts[:k1], self.show_best_deals[:k1])
+                   if sbd or cut >= md]
+        else:
+            out = [t for t, md in zip(self.tids[:k1], self.min_discounts[:k1]) if cut >= md]
+        out.extend(self.tids[k1:k2])
+        out.extend(t for t, lpd in zip(self.tids[k2:], self.low_price_discounts[k2:]) if cut >= lpd)
+        return out
+
+
+# reverse index from game id to the users caching it, with their thresholds
+class SubscriberIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {tid: (configs tuple, {gid: excluded price}, [gid])}
+        self.users = {}
+        # {gid: {tid}}
+        self.games = {}
+        # {gid: Subscribers}, rebuilt lazily when the users of a game change
+        self.bands = {}
+
+    def __drop(self, tid):
+        old = self.users.pop(tid, None)
+        if old is None:
+            return
+        for gid in old[2]:
+            tids = self.games.get(gid)
+            if tids is not None:
+                tids.discard(tid)
+                if len(tids) <= 0:
+                    del self.games[gid]
+            self.bands.pop(gid, None)
+
+    # adds or replaces a user
+    def add_user(self, user_data):
+        cfg = user_data.configs
+        configs = (cfg.max_price, cfg.min_discount, cfg.low_price_min_discount, cfg.show_best_deals)
+        gids = [g.gid for g in user_data.cache]
+        with self.lock:
+            self.__drop(user_data.tid)
+            self.users[user_data.tid] = (configs, user_data.get_exclude_map(), gids)
+            for gid in gids:
+                self.games.setdefault(gid, set()).add(user_data.tid)
+                self.bands.pop(gid, None)
+
+    def remove_user(self, tid):
+        with self.lock:
+            self.__drop(tid)
+
+    def __len__(self):
+        return len(self.users)
+
+    # users that should be notified about the given price of a game, following Game.is_applicable
+    def match(self, gid, price, original_price, cut, recommended=False):
+        with self.lock:
+            bands = self.bands.get(gid)
+            if bands is None:
+                tids = self.games.get(gid)
+                if tids is None:
+                    return []
+                bands = Subscribers([(tid,) + self.users[tid][0] for tid in tids])
+                # {excluded price: {tid}}
+                for tid in tids:
+                    p = self.users[tid][1].get(gid)
+                    if p is not None:
+                        bands.excluded.setdefault(p, set()).add(tid)
+                self.bands[gid] = bands
+            matches = bands.match(price, original_price, cut, recommended)
+            excluded = bands.excluded.get(price)
+            if excluded is None:
+                return matches
+            return [tid for tid in matches if tid not in excluded]
+
+    def match_game(self, game):
+        return self.match(game.gid, game.price, game.original_price, game.cut, game.is_recommended())
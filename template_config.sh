@@ -8,4 +8,29 @@ export STEAM_UPDATES_MINUTE=XX
 # isthereanydeal api key (optional), get one here: https://isthereanydeal.com/apps/new/
 export ISTHEREANYDEAL_API_KEY="XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX"
 
-export NOTIFICATION_FILE="$HOME/steam_notification"
\ No newline at end of file
+export NOTIFICATION_FILE="$HOME/steam_notification"
+
+# size limit of the http responses cache in MB (optional, defaults to 64)
+#export HTTP_CACHE_SIZE_MB=64
+
+# hours a stored isthereanydeal price is reused for games whose steam price did not change (optional, defaults to 72)
+#export DEAL_MAX_AGE_HOURS=72
+
+# number of users refreshed in parallel by the daily update (optional, defaults to 4)
+#export UPDATE_WORKERS=4
+
+# number of /update requests refreshed in parallel (optional, defaults to 2)
+#export REFRESH_WORKERS=2
+
+# hours /deals and /alldeals answer from a user cache before refreshing it in background (optional, defaults to 12)
+#export CACHE_FRESHNESS_HOURS=12
+
+# user data storage, "json" (one file per user), "journal" (json snapshot plus change journal per user)
+# or "sqlite" (optional, defaults to json); existing json users are imported the first time sqlite is enabled
+#export USERDATA_BACKEND=json
+
+# number of users kept parsed in memory (optional, defaults to 256)
+#export USERDATA_CACHE_SIZE=256
+
+# encoding of json backend user files, "json" or "msgpack" (optional, defaults to json, msgpack needs the msgpack package)
+#export USERDATA_ENCODING=json
@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import logging
+import threading
+from atomicfile import atomic_write
+
+
+# json backed key -> value cache with per entry expiration,
+# None values are stored as negative entries and expire after negative_ttl
+class PersistentCache:
+    def __init__(self, cache_path, ttl, negative_ttl=None):
+        if type(cache_path) is not str:
+            raise Exception("Missing cache file")
+        self.cache_path = cache_path
+        self.ttl = ttl
+        if negative_ttl is None:
+            negative_ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if os.path.isfile(self.cache_path):
+            f = open(self.cache_path, 'r')
+            try:
+                self.entries = json.load(f)
+            except:
+                logging.warning("invalid cache file {}, starting empty".format(self.cache_path))
+                self.entries = {}
+            f.close()
+
+    def __is_fresh(self, entry, now):
+        if entry[0] is None:
+            return now - entry[1] < self.negative_ttl
+        return now - entry[1] < self.ttl
+
+    # returns a (found, value) tuple, value is None for negative entries
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.__is_fresh(entry, time.time()):
+                return True, entry[0]
+        return False, None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = [value, time.time()]
+            self.dirty = True
+
+    # splits keys in a ({key: value} hits, [missing keys]) tuple, negative hits are not included in either
+    def lookup(self, keys):
+        hits = {}
+        missing = []
+        now = time.time()
+        with self.lock:
+            for k in keys:
+                entry = self.entries.get(k)
+                if entry is not None and self.__is_fresh(entry, now):
+                    if entry[0] is not None:
+                        hits[k] = entry[0]
+                else:
+                    missing.append(k)
+        return hits, missing
+
+    def purge(self):
+        now = time.time()
+        with self.lock:
+            expired = [k for k, e in self.entries.items() if not self.__is_fresh(e, now)]
+            for k in expired:
+                del self.entries[k]
+            if len(expired) > 0:
+                self.dirty = True
+
+    def store(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self.entries)
+            self.dirty = False
+
+        atomic_write(self.cache_path, data)
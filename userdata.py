@@ -1,6 +1,18 @@
 import os
 import json
+import time
+import logging
+import threading
+from collections import OrderedDict
 from isthedeal_wrapper import Deal
+from gameindex import GameIndex
+from atomicfile import atomic_write
+
+# optional binary encoding for user files
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 # userdata:
@@ -8,6 +20,7 @@ from isthedeal_wrapper import Deal
 #   dault_user_configs
 #   [exclude, ..]
 #   cache: game list
+#   updated: last cache refresh time
 
 # user_configs:
 #   max_price
@@ -119,12 +132,17 @@ class Game:
         self.name = name
         self.deal = deal
 
+    # deals may lack a current offer (no shop listed) or prices
     def is_recommended(self):
         if type(self.deal) is Deal:
-            if self.price <= self.deal.historical.price:
+            historical = self.deal.historical
+            if historical is None or historical.price is None:
+                return False
+            if self.price <= historical.price:
                 return True
-            if self.deal.current.price <= self.deal.historical.price:
-                if self.deal.current.shop['id'] == 'steam':
+            current = self.deal.current
+            if current is not None and current.price is not None and current.price <= historical.price:
+                if current.shop['id'] == 'steam':
                     return True
         return False
 
@@ -213,10 +231,12 @@ class Game:
 
 
 class UserData:
-    def __init__(self, tid, username, configs, exclude_list=None, cache=None):
+    def __init__(self, tid, username, configs, exclude_list=None, cache=None, updated=None):
         self.tid = tid
         self.username = username
         self.configs = configs
+        # unix time of the last cache refresh, None if unknown
+        self.updated = updated
         if exclude_list is None:
             self.exclude_list = []
         else:
@@ -225,6 +245,9 @@ class UserData:
             self.cache = []
         else:
             self.cache = cache
+        # query index of cache, rebuilt whenever a new cache list is assigned
+        self.index = None
+        self.index_source = None
 
     def __str__(self):
         ret = "Telegram id: {}, Steam username: {}".format(self.tid, self.username)
@@ -243,37 +266,222 @@ class UserData:
     def get_default(tid):
         return UserData(tid, "gabelogannewell", UserConfigs.get_default())
 
+    def get_index(self):
+        if self.index is None or self.index_source is not self.cache:
+            self.index = GameIndex(self.cache)
+            self.index_source = self.cache
+        return self.index
+
+    # seconds since the last cache refresh, None if unknown
+    def cache_age(self):
+        if self.updated is None:
+            return None
+        return time.time() - self.updated
+
     def get_exclude_map(self):
         return {x.gid: x.price for x in self.exclude_list}
 
     def set_exclude_cache(self):
         self.exclude_list = [Exclude(g.gid, g.price) for g in self.cache]
 
-    def to_dict(self):
-        return {
+    # swaps cached games for the catalog instances; games of a cache refreshed after
+    # the catalog entries were written replace them, older copies never do
+    def intern_cache(self, catalog):
+        interned = catalog.intern_all(self.cache, self.updated)
+        if any(a is not b for a, b in zip(interned, self.cache)):
+            self.cache = interned
+
+    # with a catalog, games are stored there and only their ids are kept in the user dictionary
+    def to_dict(self, catalog=None):
+        d = {
             'telegram_id': self.tid,
             'username': self.username,
             'configs': self.configs.to_dict(),
             'exclude_list': [x.to_dict() for x in self.exclude_list],
-            'cache': [g.to_dict() for g in self.cache]
+            'updated': self.updated
         }
+        if catalog is not None:
+            self.intern_cache(catalog)
+            d['cache_ids'] = [g.gid for g in self.cache]
+        else:
+            d['cache'] = [g.to_dict() for g in self.cache]
+        return d
 
     @staticmethod
-    def from_dict(ddata):
+    def from_dict(ddata, catalog=None):
+        if 'cache_ids' in ddata:
+            if catalog is None:
+                raise Exception("user data references a game catalog")
+            cache = []
+            missing = []
+            for gid in ddata['cache_ids']:
+                g = catalog.get(gid)
+                if g is None:
+                    missing.append(gid)
+                else:
+                    cache.append(g)
+            if len(missing) > 0:
+                logging.warning("dropping games missing from catalog for {}: {}".format(ddata['telegram_id'],
+                                                                                      ", ".join(missing)))
+        else:
+            cache = [Game.from_dict(g) for g in ddata['cache']]
+            if catalog is not None:
+                cache = catalog.intern_all(cache)
         return UserData(
             ddata['telegram_id'],
             ddata['username'],
             UserConfigs.from_dict(ddata['configs']),
             [Exclude.from_dict(x) for x in ddata['exclude_list']],
-            [Game.from_dict(g) for g in ddata['cache']]
+            cache,
+            ddata.get('updated')
         )
 
 
-class UserDataManager:
+# games shared by every user, keyed by id, so that each game and its market
+# information is kept once in memory and on disk; games added since the last
+# write of the catalog file are appended to a journal next to it
+class GameCatalog:
+    # minimum seconds between two writes of the catalog file, see store
+    STORE_INTERVAL = 60
+
     def __init__(self, cache_path):
+        if type(cache_path) is not str:
+            raise Exception("Missing catalog file")
+        self.cache_path = cache_path
+        self.journal_path = cache_path + ".journal"
+        self.games = {}
+        # {game id: refresh time of the user cache that wrote the entry}, entries read from disk have none
+        self.updated = {}
+        # {game id: last time a stored user referenced the entry in this process}
+        self.used = {}
+        self.lock = threading.Lock()
+        # serializes writes, so that a store returns only once its changes are on disk
+        self.write_lock = threading.Lock()
+        self.dirty = False
+        # games added since the last write, user files referencing them must not be written before
+        self.added = []
+        self.last_store = 0
+        self.load()
+
+    def load(self):
+        if os.path.isfile(self.cache_path):
+            f = open(self.cache_path, 'r')
+            try:
+                self.games = {gid: Game.from_dict(g) for gid, g in json.load(f).items()}
+            except Exception as e:
+                logging.error("invalid game catalog {}: {}".format(self.cache_path, e))
+                self.games = {}
+            f.close()
+        if os.path.isfile(self.journal_path):
+            f = open(self.journal_path, 'r')
+            for l in f:
+                try:
+                    g = Game.from_dict(json.loads(l))
+                except ValueError:
+                    logging.warning("skipping incomplete game catalog record")
+                    continue
+                # journals left by an interrupted write hold games already in the catalog file, maybe older
+                self.games.setdefault(g.gid, g)
+            f.close()
+            # merged in the catalog file by the next store, appending after a torn record would lose the next one
+            self.dirty = True
+
+    def get(self, gid):
+        with self.lock:
+            return self.games.get(gid)
+
+    # returns the catalog instances of games; games unknown to the catalog are added, known ones are
+    # replaced only by games of a user cache refreshed (at unix time updated) after the entry was written
+    def intern_all(self, games, updated=None):
+        out = []
+        now = time.time()
+        with self.lock:
+            for g in games:
+                self.used[g.gid] = now
+                current = self.games.get(g.gid)
+                if current is None:
+                    self.added.append(g)
+                if current is None or (current is not g and updated is not None and
+                                       updated > self.updated.get(g.gid, 0)):
+                    self.games[g.gid] = g
+                    if updated is not None:
+                        self.updated[g.gid] = updated
+                    self.dirty = True
+                    current = g
+                out.append(current)
+        return out
+
+    # drops games not in keep, except those referenced by users stored after the unix time since,
+    # which may be missing from keep if it was collected meanwhile
+    def prune(self, keep, since):
+        with self.lock:
+            unused = [gid for gid in self.games.keys() if gid not in keep and self.used.get(gid, 0) < since]
+            for gid in unused:
+                del self.games[gid]
+                self.updated.pop(gid, None)
+                self.used.pop(gid, None)
+            if len(unused) > 0:
+                self.dirty = True
+        return len(unused)
+
+    # writes the catalog if it changed, at most once every STORE_INTERVAL seconds unless forced;
+    # in between games added are appended to the journal, so that user files never reference
+    # games missing on disk
+    def store(self, force=False):
+        with self.write_lock:
+            with self.lock:
+                if self.dirty and (force or time.time() - self.last_store >= GameCatalog.STORE_INTERVAL):
+                    data = json.dumps({gid: g.to_dict() for gid, g in self.games.items()})
+                    records = None
+                    self.dirty = False
+                    self.last_store = time.time()
+                elif len(self.added) > 0:
+                    data = None
+                    records = "".join(json.dumps(g.to_dict()) + "\n" for g in self.added)
+                else:
+                    return
+                self.added = []
+            if data is not None:
+                atomic_write(self.cache_path, data)
+                if os.path.isfile(self.journal_path):
+                    os.remove(self.journal_path)
+            else:
+                f = open(self.journal_path, 'a')
+                f.write(records)
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+
+
+class UserDataManager:
+    ENCODINGS = ['json', 'msgpack']
+
+    # encoding is used for writing, files in either encoding are always readable;
+    # with a GameCatalog cached games are shared among users instead of stored in each file
+    def __init__(self, cache_path, encoding='json', catalog=None):
         if type(cache_path) is not str or not os.path.isdir(cache_path):
             raise Exception("Missing cache path")
+        if encoding not in UserDataManager.ENCODINGS:
+            raise Exception("Unknown encoding {}".format(encoding))
+        if encoding == 'msgpack' and msgpack is None:
+            raise Exception("msgpack encoding needs the msgpack package")
         self.cache_path = cache_path
+        self.encoding = encoding
+        self.catalog = catalog
+
+    @staticmethod
+    def decode(data):
+        # json documents always start with '{', msgpack maps never do
+        if data[:1] == b'{':
+            return json.loads(data.decode('utf-8'))
+        if msgpack is None:
+            raise Exception("msgpack encoded file, but msgpack is not installed")
+        return msgpack.unpackb(data, raw=False)
+
+    def encode(self, ddata):
+        if self.encoding == 'msgpack':
+            return msgpack.packb(ddata, use_bin_type=True)
+        return json.dumps(ddata)
 
     def get_userlist(self):
         list = []
@@ -295,12 +503,18 @@ class UserDataManager:
         fpath = os.path.join(self.cache_path, str(tid))
 
         if os.path.isfile(fpath):
-            f = open(fpath, 'r')
+            f = open(fpath, 'rb')
             try:
-                d = UserData.from_dict(json.load(f))
-            except:
+                ddata = UserDataManager.decode(f.read())
+                d = UserData.from_dict(ddata, self.catalog)
+            except Exception as e:
+                logging.error("invalid userdata for {}: {}".format(tid, e))
                 d = None
             f.close()
+            # rewrite files holding raw market data in the compact format, or games now kept in the catalog
+            if d is not None and 'cache' in ddata and (self.catalog is not None or
+                    any(g['deal'] is not None and 'v' not in g['deal'] for g in ddata['cache'])):
+                self.store_userdata(d)
             return d
         return None
 
@@ -317,11 +531,98 @@ class UserDataManager:
 
         fpath = self.cache_path + "/" + str(user_data.tid)
 
-        if os.path.isfile(fpath):
-            mode = "w"
-        else:
-            mode = "x"
+        data = self.encode(user_data.to_dict(self.catalog))
+        if self.catalog is not None:
+            self.catalog.store()
+        atomic_write(fpath, data)
+
+
+# bounded LRU of parsed UserData in front of another manager (json files or sqlite),
+# stores are written through to the backend before returning and kept in memory
+class CachedUserDataManager:
+    SIZE_DEFAULT = 256
+
+    def __init__(self, backend, size=None):
+        if size is None:
+            size = CachedUserDataManager.SIZE_DEFAULT
+        self.backend = backend
+        self.size = size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.tid_locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    # lock serializing loads and stores of a single user
+    def get_lock(self, tid):
+        with self.lock:
+            l = self.tid_locks.get(tid)
+            if l is None:
+                l = threading.RLock()
+                self.tid_locks[tid] = l
+            return l
+
+    # callers get their own UserData, so that unsaved changes never leak into the cache,
+    # the cache list and its index are shared since the list is always replaced, never modified in place
+    @staticmethod
+    def __copy(ud):
+        c = UserData(ud.tid, ud.username, UserConfigs.from_dict(ud.configs.to_dict()),
+                     list(ud.exclude_list), ud.cache, ud.updated)
+        c.index = ud.index
+        c.index_source = ud.index_source
+        return c
+
+    def __put(self, ud):
+        with self.lock:
+            self.cache[ud.tid] = ud
+            self.cache.move_to_end(ud.tid)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+
+    def get_userlist(self):
+        return self.backend.get_userlist()
 
-        f = open(fpath, mode)
-        json.dump(user_data.to_dict(), f)
-        f.close()
+    def get_userdata(self, tid):
+        with self.get_lock(tid):
+            with self.lock:
+                ud = self.cache.get(tid)
+                if ud is not None:
+                    self.cache.move_to_end(tid)
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if ud is None:
+                ud = self.backend.get_userdata(tid)
+                if ud is None:
+                    return None
+                self.__put(ud)
+            return CachedUserDataManager.__copy(ud)
+
+    def init_userdata(self, tid):
+        return self.backend.init_userdata(tid)
+
+    def store_userdata(self, user_data):
+        with self.get_lock(user_data.tid):
+            self.backend.store_userdata(user_data)
+            self.__put(CachedUserDataManager.__copy(user_data))
+
+    # read-modify-write of a stored user: fn gets the current UserData and changes it in place, or returns
+    # False to leave it untouched; loads and stores of tid by other threads wait until it is stored.
+    # Returns the resulting UserData, None if tid is unknown
+    def update_userdata(self, tid, fn):
+        with self.get_lock(tid):
+            ud = self.get_userdata(tid)
+            if ud is None:
+                return None
+            if fn(ud) is not False:
+                self.store_userdata(ud)
+            return ud
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.cache),
+                'max_size': self.size
+            }
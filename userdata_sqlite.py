@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import sqlite3
+import logging
+import threading
+from isthedeal_wrapper import Deal
+from userdata import UserData, UserConfigs, Exclude, Game, UserDataManager, GameCatalog
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    tid INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS configs (
+    tid INTEGER PRIMARY KEY REFERENCES users(tid) ON DELETE CASCADE,
+    max_price REAL,
+    min_discount INTEGER,
+    low_price_min_discount INTEGER,
+    show_best_deals INTEGER,
+    humble_bundle_enabled INTEGER
+);
+CREATE TABLE IF NOT EXISTS excludes (
+    tid INTEGER NOT NULL REFERENCES users(tid) ON DELETE CASCADE,
+    gid TEXT NOT NULL,
+    price REAL,
+    PRIMARY KEY (tid, gid)
+);
+CREATE TABLE IF NOT EXISTS games (
+    tid INTEGER NOT NULL REFERENCES users(tid) ON DELETE CASCADE,
+    gid TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    original_price REAL,
+    price REAL,
+    cut INTEGER,
+    link TEXT,
+    name TEXT,
+    deal TEXT,
+    PRIMARY KEY (tid, gid)
+);
+CREATE INDEX IF NOT EXISTS games_by_gid ON games (gid);
+"""
+
+
+def game_row(position, g):
+    deal = None
+    if g.deal is not None:
+        deal = json.dumps(g.deal.to_dict(), sort_keys=True)
+    return position, g.original_price, g.price, g.cut, g.link, g.name, deal
+
+
+# same interface as userdata.UserDataManager, backed by a sqlite database
+class SqliteUserDataManager:
+    def __init__(self, db_path):
+        if type(db_path) is not str:
+            raise Exception("Missing database path")
+        self.db_path = db_path
+        # sqlite connections can not be shared among threads
+        self.local = threading.local()
+        c = self.__connection()
+        c.executescript(SCHEMA)
+        # databases created before cache refresh times were stored
+        if 'updated' not in [r[1] for r in c.execute("PRAGMA table_info(users)")]:
+            c.execute("ALTER TABLE users ADD COLUMN updated REAL")
+        c.commit()
+
+    def __connection(self):
+        c = getattr(self.local, 'connection', None)
+        if c is None:
+            c = sqlite3.connect(self.db_path, timeout=30)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA foreign_keys=ON")
+            self.local.connection = c
+        return c
+
+    def get_userlist(self):
+        return [r[0] for r in self.__connection().execute("SELECT tid FROM users")]
+
+    # reads userdata, returns None if user is unknown
+    def get_userdata(self, tid):
+        if type(tid) is not int:
+            raise Exception("Telegram id needs to be a valid int, found type {}".format(type(tid)))
+
+        c = self.__connection()
+        row = c.execute("SELECT username, updated FROM users WHERE tid = ?", (tid,)).fetchone()
+        if row is None:
+            return None
+        username, updated = row
+
+        row = c.execute("SELECT max_price, min_discount, low_price_min_discount, show_best_deals, "
+                        "humble_bundle_enabled FROM configs WHERE tid = ?", (tid,)).fetchone()
+        if row is None:
+            configs = UserConfigs.get_default()
+        else:
+            configs = UserConfigs(row[0], row[1], row[2],
+                                  None if row[3] is None else bool(row[3]),
+                                  None if row[4] is None else bool(row[4]))
+
+        excludes = [Exclude(r[0], r[1]) for r in
+                    c.execute("SELECT gid, price FROM excludes WHERE tid = ?", (tid,))]
+
+        cache = []
+        for r in c.execute("SELECT gid, original_price, price, cut, link, name, deal FROM games "
+                           "WHERE tid = ? ORDER BY position", (tid,)):
+            try:
+                deal = None
+                if r[6] is not None:
+                    deal = Deal.from_dict(json.loads(r[6]))
+                cache.append(Game(r[0], r[1], r[2], r[3], r[4], r[5], deal))
+            except Exception as e:
+                logging.error("invalid cached game {} for {}: {}".format(r[0], tid, e))
+
+        return UserData(tid, username, configs, excludes, cache, updated)
+
+    @staticmethod
+    def init_userdata(tid):
+        return UserDataManager.init_userdata(tid)
+
+    # only rows that differ from the stored ones are written
+    def store_userdata(self, user_data):
+        if type(user_data) is not UserData:
+            raise Exception("user_data must be a UserData object")
+
+        tid = user_data.tid
+        c = self.__connection()
+        with c:
+            c.execute("INSERT INTO users (tid, username, updated) VALUES (?, ?, ?) "
+                      "ON CONFLICT(tid) DO UPDATE SET username = excluded.username, updated = excluded.updated "
+                      "WHERE (username, updated) IS NOT (excluded.username, excluded.updated)",
+                      (tid, user_data.username, user_data.updated))
+
+            cfg = user_data.configs
+            c.execute("INSERT INTO configs (tid, max_price, min_discount, low_price_min_discount, show_best_deals, "
+                      "humble_bundle_enabled) VALUES (?, ?, ?, ?, ?, ?) "
+                      "ON CONFLICT(tid) DO UPDATE SET max_price = excluded.max_price, "
+                      "min_discount = excluded.min_discount, "
+                      "low_price_min_discount = excluded.low_price_min_discount, "
+                      "show_best_deals = excluded.show_best_deals, "
+                      "humble_bundle_enabled = excluded.humble_bundle_enabled "
+                      "WHERE (max_price, min_discount, low_price_min_discount, show_best_deals, humble_bundle_enabled) "
+                      "IS NOT (excluded.max_price, excluded.min_discount, excluded.low_price_min_discount, "
+                      "excluded.show_best_deals, excluded.humble_bundle_enabled)",
+                      (tid, cfg.max_price, cfg.min_discount, cfg.low_price_min_discount,
+                       int(cfg.show_best_deals), int(cfg.humble_bundle_enabled)))
+
+            stored = {r[0]: r[1] for r in c.execute("SELECT gid, price FROM excludes WHERE tid = ?", (tid,))}
+            current = user_data.get_exclude_map()
+            c.executemany("DELETE FROM excludes WHERE tid = ? AND gid = ?",
+                          [(tid, gid) for gid in stored.keys() if gid not in current])
+            c.executemany("INSERT OR REPLACE INTO excludes (tid, gid, price) VALUES (?, ?, ?)",
+                          [(tid, gid, p) for gid, p in current.items() if gid not in stored or stored[gid] != p])
+
+            stored = {r[0]: tuple(r[1:]) for r in
+                      c.execute("SELECT gid, position, original_price, price, cut, link, name, deal "
+                                "FROM games WHERE tid = ?", (tid,))}
+            current = {}
+            for position, g in enumerate(user_data.cache):
+                current[g.gid] = game_row(position, g)
+            c.executemany("DELETE FROM games WHERE tid = ? AND gid = ?",
+                          [(tid, gid) for gid in stored.keys() if gid not in current])
+            c.executemany("INSERT OR REPLACE INTO games (tid, gid, position, original_price, price, cut, link, name, "
+                          "deal) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          [(tid, gid) + row for gid, row in current.items() if stored.get(gid) != row])
+
+    # one shot import of the json files written by userdata.UserDataManager,
+    # catalog is the GameCatalog holding the games of files that only reference them
+    def migrate_from_dir(self, cache_path, catalog=None):
+        source = UserDataManager(cache_path, catalog=catalog)
+        count = 0
+        for tid in source.get_userlist():
+            ud = source.get_userdata(tid)
+            if ud is None:
+                logging.warning("skipping unreadable user {}".format(tid))
+                continue
+            self.store_userdata(ud)
+            count += 1
+        logging.info("migrated {} users from {}".format(count, cache_path))
+        return count
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4) or not os.path.isdir(sys.argv[1]):
+        print("usage: {} TIDS_DIR DATABASE [CATALOG]\n"
+              "CATALOG defaults to the games_catalog file next to TIDS_DIR".format(sys.argv[0]))
+        exit(1)
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) > 3:
+        catalog_path = sys.argv[3]
+    else:
+        catalog_path = os.path.join(os.path.dirname(os.path.abspath(sys.argv[1])), "games_catalog")
+    catalog = None
+    if os.path.isfile(catalog_path):
+        catalog = GameCatalog(catalog_path)
+    SqliteUserDataManager(sys.argv[2]).migrate_from_dir(sys.argv[1], catalog)